@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""analytics.py - Vectorized statistics over a game export.
+
+Reads the NDJSON written by export_games.py in fixed-size batches and
+folds each batch into running NumPy totals, so memory stays constant in
+the number of games (per-player totals grow only with the number of
+players). Reports opening-move win rates, average game length, draw
+rates and per-player records as JSON.
+
+Usage:
+    python analytics.py EXPORT [--batch-size N] [--top N]
+"""
+
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+BATCH_SIZE = 10000
+RESULTS = {'player1': 0, 'player2': 1, 'draw': 2, 'cancelled': 3}
+PLAYER1_WON, PLAYER2_WON, DRAW, CANCELLED = range(4)
+WINS, LOSSES, DRAWS = range(3)
+
+
+class GameStats(object):
+    """Running totals over batches of exported games."""
+
+    def __init__(self):
+        self.games = 0
+        self.cancelled = 0
+        self.draws = 0
+        self.moves = 0
+        # board_size -> (games per opening square, opener wins per square)
+        self.openings = {}
+        self.player_ids = {}
+        self.player_records = np.zeros((0, 3), dtype=np.int64)
+
+    def _player_index(self, player_ids):
+        """Maps player ids to rows of player_records, adding new rows."""
+        for player_id in player_ids:
+            if player_id is not None and player_id not in self.player_ids:
+                self.player_ids[player_id] = len(self.player_ids)
+        missing = len(self.player_ids) - len(self.player_records)
+        if missing:
+            self.player_records = np.vstack(
+                [self.player_records, np.zeros((missing, 3), np.int64)])
+        return np.array([self.player_ids.get(player_id, -1)
+                         for player_id in player_ids], dtype=np.int64)
+
+    def add_batch(self, records):
+        """Folds a batch of export records into the totals."""
+        results = np.array([RESULTS[r['result']] for r in records])
+        lengths = np.array([len(r['moves']) for r in records])
+        sizes = np.array([r['board_size'] for r in records])
+        first = np.array([r['first'] or 0 for r in records])
+        opening = np.array([r['moves'][0] if r['moves'] else -1
+                            for r in records])
+        player1 = self._player_index([r['player1'] for r in records])
+        player2 = self._player_index([r['player2'] for r in records])
+
+        finished = results != CANCELLED
+        self.cancelled += int(np.count_nonzero(~finished))
+        self.games += int(np.count_nonzero(finished))
+        self.draws += int(np.count_nonzero(results == DRAW))
+        self.moves += int(lengths[finished].sum())
+
+        opener_won = ((results == PLAYER1_WON) & (first == 1)) | \
+            ((results == PLAYER2_WON) & (first == 2))
+        played = finished & (opening >= 0)
+        for size in np.unique(sizes[played]):
+            in_size = played & (sizes == size)
+            squares = int(size) ** 2
+            games, wins = self.openings.setdefault(
+                int(size), (np.zeros(squares, np.int64),
+                            np.zeros(squares, np.int64)))
+            games += np.bincount(opening[in_size], minlength=squares)
+            wins += np.bincount(opening[in_size & opener_won],
+                                minlength=squares)
+
+        both = player2 >= 0
+        for outcome, p1_column, p2_column in (
+                (PLAYER1_WON, WINS, LOSSES),
+                (PLAYER2_WON, LOSSES, WINS),
+                (DRAW, DRAWS, DRAWS)):
+            rows = (results == outcome) & both
+            np.add.at(self.player_records, (player1[rows], p1_column), 1)
+            np.add.at(self.player_records, (player2[rows], p2_column), 1)
+
+    def report(self, top=20):
+        """Returns the statistics as a JSON-serializable dict."""
+        openings = {}
+        for size, (games, wins) in sorted(self.openings.items()):
+            rates = np.divide(wins, games, out=np.zeros(len(games)),
+                              where=games > 0)
+            openings['{0}x{0}'.format(size)] = [
+                {'square': int(square), 'games': int(games[square]),
+                 'opener_win_rate': round(float(rates[square]), 4)}
+                for square in np.flatnonzero(games)]
+        names = sorted(self.player_ids, key=self.player_ids.get)
+        played = self.player_records.sum(axis=1)
+        order = np.lexsort((-self.player_records[:, DRAWS],
+                            -self.player_records[:, WINS]))[:top]
+        return {
+            'games': self.games,
+            'cancelled': self.cancelled,
+            'draw_rate': round(float(self.draws) / self.games, 4)
+            if self.games else 0.0,
+            'average_length': round(float(self.moves) / self.games, 2)
+            if self.games else 0.0,
+            'openings': openings,
+            'players': [{'player': names[row],
+                         'games': int(played[row]),
+                         'wins': int(self.player_records[row, WINS]),
+                         'losses': int(self.player_records[row, LOSSES]),
+                         'draws': int(self.player_records[row, DRAWS])}
+                        for row in order]}
+
+
+def analyse(path, batch_size=BATCH_SIZE):
+    """Returns the GameStats for an export file."""
+    stats = GameStats()
+    with open(path) as f:
+        while True:
+            batch = [json.loads(line) for line in
+                     itertools.islice(f, batch_size) if line.strip()]
+            if not batch:
+                break
+            stats.add_batch(batch)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('export')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    stats = analyse(args.export, args.batch_size)
+    print json.dumps(stats.report(args.top), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,40 @@ Tic-Tac-Toe. More details on the various endpoints and their
 expected parameters can be found in README.md"""
 
 
+import functools
 import logging
+import time
 import endpoints
-from protorpc import remote, messages
+from protorpc import remote, messages, protojson
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from models.game import (Game,
+                         MAX_BOARD_SIZE,
+                         GAME_FORM_FIELDS,
+                         DELTA_FIELDS,
                          NewGameForm,
+                         BulkGameForm,
                          GameForm,
                          MakeMoveForm,
                          JoinGameForm,
                          GameForms,
-                         GameHistoryForm)
-from models.user import User, StringMessage, LeaderboardForms
-from utils import get_by_urlsafe, get_by_passcode
+                         GameHistoryForm,
+                         GameVersionForm,
+                         BatchMoveForm,
+                         MoveResultForm,
+                         MoveResultForms)
+from models.user import (User,
+                         StringMessage,
+                         LeaderboardForm,
+                         LeaderboardForms)
+from models.session import Session
+from models import counter, leaderboard, matchmaking, stats
+from models.stats import PlayerStatsForm, HeadToHeadForm
+from utils import get_by_urlsafe, get_by_urlsafe_async, \
+    get_by_passcode_async, key_from_urlsafe
+from instrumentation import instrumented
+from ratelimit import rate_limited
 """If the request contains path or querystring arguments, you
 cannot use a simple Message class. Instead, you must use a
 ResourceContaineClass."""
@@ -25,13 +46,114 @@ NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
-    MakeMoveForm, urlsafe_game_key=messages.StringField(1),)
+    MakeMoveForm, urlsafe_game_key=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    delta=messages.BooleanField(3, default=False),)
 JOIN_GAME_REQUEST = endpoints.ResourceContainer(
-    JoinGameForm, passcode=messages.StringField(1))
+    JoinGameForm, passcode=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    delta=messages.BooleanField(3, default=False),)
 CANCEL_GAME_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    delta=messages.BooleanField(3, default=False),)
 GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    since=messages.IntegerField(2, default=0),)
+GAME_VERSION_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2, default=0),)
+WAIT_FOR_TURN_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2, default=0),
+    timeout=messages.IntegerField(3, default=20),)
+MAX_WAIT_SECONDS = 25
+WAIT_POLL_SECONDS = 0.5
+DEFAULT_RANKINGS_PAGE = 10
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, default=DEFAULT_RANKINGS_PAGE),
+    cursor=messages.StringField(2),)
+MAX_RANKINGS_PAGE = 100
+MAX_BATCH_MOVES = 500
+MAX_BULK_GAMES = 500
+# Users allowed to create games for others with new_games, by name.
+ORGANISERS = set()
+HEAD_TO_HEAD_REQUEST = endpoints.ResourceContainer(
+    opponent_name=messages.StringField(1, required=True),)
+
+
+def _form_fields(request):
+    """Returns the GameForm fields a request asked for with its fields or
+    delta parameters, or None for a full form."""
+    if request.delta:
+        return DELTA_FIELDS
+    if not request.fields:
+        return None
+    fields = frozenset(request.fields)
+    unknown = fields - GAME_FORM_FIELDS
+    if unknown:
+        raise endpoints.BadRequestException(
+            'Unknown fields: ' + ', '.join(sorted(unknown)))
+    return fields
+
+
+def _check_board(board_size, win_length):
+    if not 1 <= board_size <= MAX_BOARD_SIZE:
+        raise endpoints.BadRequestException(
+            'board_size must be between 1 and {}!'.format(MAX_BOARD_SIZE))
+    if not 1 <= win_length <= board_size:
+        raise endpoints.BadRequestException(
+            'win_length must be between 1 and board_size!')
+
+
+def rankings_page(limit, cursor=None):
+    """Returns a page of the leaderboard. The first page is served from
+    memcache when it can be and cached when it can't. The computer player
+    isn't ranked."""
+    if not cursor:
+        cached = leaderboard.get_top_page(limit)
+        if cached:
+            return protojson.decode_message(LeaderboardForms, cached)
+    query = User.query().order(-User.score)
+    projection = [User.name, User.score]
+    try:
+        start = Cursor(urlsafe=cursor) if cursor else None
+        users, next_cursor, more = query.fetch_page(
+            limit, start_cursor=start, projection=projection)
+    except (datastore_errors.BadArgumentError,
+            datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    if any(user.is_computer for user in users):
+        # Filtered here rather than in the query, which can't exclude a
+        # key while ordering by score; the page is topped up by one.
+        users = [user for user in users if not user.is_computer]
+        if more and next_cursor:
+            extra, next_cursor, more = query.fetch_page(
+                1, start_cursor=next_cursor, projection=projection)
+            users += extra
+    totals = counter.get_totals([user.key for user in users])
+    page = LeaderboardForms(items=[user.to_form(totals=totals[user.key])
+                                   for user in users])
+    if more and next_cursor:
+        page.next_cursor = next_cursor.urlsafe()
+    if not cursor:
+        leaderboard.set_top_page(limit, protojson.encode_message(page))
+    return page
+
+
+def with_session(func):
+    """Runs an endpoint with a fresh request-scoped Session, commits the
+    entities it changed in one put_multi and reports its datastore gets
+    and puts."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        self.session = Session()
+        response = func(self, request)
+        self.session.flush()
+        self.session.report(func.__name__)
+        return response
+    return wrapper
 
 
 @endpoints.api(name='tic_tac_toe', version='v1')
@@ -41,66 +163,155 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
+    @rate_limited
+    @with_session
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         name = str(endpoints.get_current_user())
         email = str(endpoints.get_current_user().email())
-        if User.query(User.name == name).get():
+        user = None
+        if not User.get_by_name(name):
+            user = User.create(name, email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=name, email=email)
-        user.put()
+        leaderboard.record_scores([(None, user.score)])
         return StringMessage(message='User {} created!'.format(
             name))
 
-    @endpoints.method(response_message=LeaderboardForms,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=LeaderboardForms,
                       path='user/games/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
+    @with_session
     def get_user_rankings(self, request):
-        """Return rankings for all users."""
-        users = User.query()
-        return LeaderboardForms(items=[user.to_form()
-                                       for user in users])
+        """Return a page of users ordered by score, best first. Pass the
+        returned next_cursor back to fetch the following page."""
+        return rankings_page(min(max(request.limit, 1), MAX_RANKINGS_PAGE),
+                             request.cursor)
+
+    @endpoints.method(response_message=LeaderboardForm,
+                      path='user/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    @with_session
+    def get_user_rank(self, request):
+        """Return the current user's record and leaderboard rank."""
+        user = self._getUser()
+        return user.to_form(leaderboard.rank_of(user.score))
+
+    @endpoints.method(response_message=PlayerStatsForm,
+                      path='user/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented
+    @with_session
+    def get_user_stats(self, request):
+        """Return the current user's streaks and most recent results,
+        newest first."""
+        user = self._getUser()
+        player_stats = stats.player_key(user.key).get() or \
+            stats.PlayerStats()
+        return player_stats.to_form(user.name)
+
+    @endpoints.method(request_message=HEAD_TO_HEAD_REQUEST,
+                      response_message=HeadToHeadForm,
+                      path='user/record/{opponent_name}',
+                      name='get_head_to_head',
+                      http_method='GET')
+    @instrumented
+    @with_session
+    def get_head_to_head(self, request):
+        """Return the current user's record against another player."""
+        # Both players are looked up at once. The record is keyed by both
+        # of their ids, so it can only be fetched after them.
+        user_future = self._get_user_async()
+        opponent_future = User.get_by_name_async(request.opponent_name)
+        user = user_future.get_result()
+        opponent = opponent_future.get_result()
+        if not opponent:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        pair = stats.pair_key(user.key, opponent.key).get()
+        if pair is None:
+            pair = stats.HeadToHead(key=stats.pair_key(user.key,
+                                                       opponent.key))
+        return pair.to_form(user.key, user.name, opponent.name)
 
     def _getUser(self):
         """Return user Profile from datastore,
         creating new one if non-existent."""
+        return self._get_user_async().get_result()
+
+    def _get_user_async(self):
+        """Asynchronous _getUser(). Authorization is checked straight away;
+        the lookup returns a Future so endpoints can start their other
+        RPCs while it runs."""
         google_user = endpoints.get_current_user()
         if not google_user:
             raise endpoints.UnauthorizedException('Authorization required')
         logging.info(google_user)
+        return self._load_user_async(google_user)
+
+    @ndb.tasklet
+    def _load_user_async(self, google_user):
         name = str(google_user)
         email = str(google_user.email())
         user_id = str(google_user)
-        user = User.query(User.name == user_id).get()
+        user = yield User.get_by_name_async(user_id)
         logging.info("user: " + str(user))
         if not user:
             logging.info("Making new user!")
-            user = User(name=name, email=email,)
-            user.put()
-        return user
+            user = User.create(name, email)
+            if user:
+                leaderboard.record_scores([(None, user.score)])
+            else:
+                user = yield User.get_by_id_async(name)
+        raise ndb.Return(self.session.add(user))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @rate_limited
+    @with_session
     def new_game(self, request):
         """Creates new game"""
-        user = self._getUser()
+        _check_board(request.board_size, request.win_length)
+        if request.vs_computer and request.player2_name:
+            raise endpoints.BadRequestException(
+                'Choose either player2_name or vs_computer!')
+        # Both players are looked up and the game's id reserved at once;
+        # the game and its players are then written in one put_multi.
+        user_future = self._get_user_async()
+        if request.vs_computer:
+            player2_future = User.computer_async()
+        elif request.player2_name:
+            player2_future = User.get_by_name_async(request.player2_name)
+        else:
+            player2_future = None
+        ids_future = Game.allocate_ids_async(1)
+        user = user_future.get_result()
+        player2 = self.session.add(player2_future.get_result()) \
+            if player2_future else None
         if request.player2_name:
-            player2 = User.query(User.name == request.player2_name).get()
             if not player2:
                 raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
+            if player2.is_computer:
+                raise endpoints.BadRequestException(
+                    'Set vs_computer to play the computer!')
             # Check that the user isn't playing against themselves.
             if player2.name == user.name:
                 raise endpoints.ConflictException(
                     'You are already in the game!')
-        else:
-            player2 = None
-        board = [0] * 9
+        board = [0] * request.board_size ** 2
         'In many instances of tic tac toe, X goes first. House rules.'
         if request.isPlayer1_X:
             isPlayer1_turn = True
@@ -109,77 +320,165 @@ class TicTacToeApi(remote.Service):
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        if request.player2_name:
-            game = Game.new_game(
-                user.key,
-                board,
-                request.isPlayer1_X,
-                isPlayer1_turn,
-                player2.key)
-        else:
-            game = Game.new_game(
-                user.key,
-                board,
-                request.isPlayer1_X,
-                isPlayer1_turn)
+        game = Game.new_game(
+            user.key,
+            board,
+            request.isPlayer1_X,
+            isPlayer1_turn,
+            player2.key if player2 else None,
+            request.board_size,
+            request.win_length,
+            request.vs_computer,
+            ndb.Key(Game, ids_future.get_result()[0]))
+        game.bind(self.session).with_fields(_form_fields(request)).save()
         user.gameKeysPlaying.append(game.key.urlsafe())
-        user.put()
-        if request.player2_name:
+        self.session.mark_dirty(user)
+        if player2 and not player2.is_computer:
             if game.player2 and game.player1 != game.player2:
                 player2.gameKeysPlaying.append(game.key.urlsafe())
-                player2.put()
+                self.session.mark_dirty(player2)
+        if game.is_computer_turn():
+            return game.play_computer_move()
         return game.to_form('Have fun playing Tic-Tac-Toe!')
 
+    @endpoints.method(request_message=BulkGameForm,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    @with_session
+    def new_games(self, request):
+        """Creates many games between named players at once, for
+        tournament organisers. Players are fetched in one batch, every
+        game id is reserved with a single allocate_ids and all the games
+        and players are written together. No game is created unless every
+        pairing is valid. Only users in ORGANISERS may call it. Returns the
+        games, passkeys included, in the order of the pairings."""
+        if len(request.pairings) > MAX_BULK_GAMES:
+            raise endpoints.BadRequestException(
+                'At most {} games per request!'.format(MAX_BULK_GAMES))
+        if self._getUser().name not in ORGANISERS:
+            raise endpoints.ForbiddenException(
+                'Only tournament organisers can create games for others!')
+        for pairing in request.pairings:
+            if pairing.player1_name == pairing.player2_name:
+                raise endpoints.ConflictException(
+                    '{} cannot play themselves!'.format(pairing.player1_name))
+            _check_board(pairing.board_size, pairing.win_length)
+        if not request.pairings:
+            return GameForms()
+        ids_future = Game.allocate_ids_async(len(request.pairings))
+        players = self._get_users_by_name(
+            set(name for pairing in request.pairings
+                for name in (pairing.player1_name, pairing.player2_name)))
+        first_id, _ = ids_future.get_result()
+        games = []
+        for game_id, pairing in enumerate(request.pairings, first_id):
+            player1 = players[pairing.player1_name]
+            player2 = players[pairing.player2_name]
+            game = Game.new_game(
+                player1.key,
+                [0] * pairing.board_size ** 2,
+                pairing.isPlayer1_X,
+                pairing.isPlayer1_X,
+                player2.key,
+                pairing.board_size,
+                pairing.win_length,
+                key=ndb.Key(Game, game_id))
+            game.bind(self.session).save()
+            for player in (player1, player2):
+                player.gameKeysPlaying.append(game.key.urlsafe())
+                self.session.mark_dirty(player)
+            games.append(game)
+        return Game.to_forms(games, self.session)
+
+    def _get_users_by_name(self, names):
+        """Returns {name: User} for names, fetching the Users keyed by
+        name in one get_multi and looking up the rest concurrently.
+        Raises NotFoundException if any is missing or is the computer."""
+        names = list(names)
+        users = self.session.get_multi([ndb.Key(User, name)
+                                        for name in names])
+        legacy = [(i, User.get_by_name_async(name))
+                  for i, (name, user) in enumerate(zip(names, users))
+                  if user is None]
+        for i, future in legacy:
+            users[i] = self.session.add(future.get_result())
+        for name, user in zip(names, users):
+            if not user or user.is_computer:
+                raise endpoints.NotFoundException(
+                    'A User named {} does not exist!'.format(name))
+        return dict(zip(names, users))
+
     @endpoints.method(response_message=GameForms,
                       path='user/games/playing',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
+    @with_session
     def get_user_games(self, request):
         """Returns all games a user is playing."""
         user = self._getUser()
         game_keys = [ndb.Key(urlsafe=wsgk) for wsgk in user.gameKeysPlaying]
         logging.info("gameKeysPlaying: %s", user.gameKeysPlaying)
-        logging.info("game keys: %s", game_keys)
-        games = ndb.get_multi(game_keys)
-        logging.info("games: %s", games)
-        return GameForms(items=[game.to_form(str(game.key.urlsafe()))
-                                for game in games])
+        games = self.session.get_multi(game_keys)
+        live = [game for game in games if isinstance(game, Game)]
+        if len(live) != len(games):
+            # Drop keys of games that no longer exist.
+            logging.info("Pruning %d stale game keys",
+                         len(games) - len(live))
+            user.gameKeysPlaying = [game.key.urlsafe() for game in live]
+            self.session.mark_dirty(user)
+        return Game.to_forms(live, self.session)
 
     @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
+    @with_session
     def get_game_history(self, request):
-        """Return the move history of a game."""
+        """Return the move history of a game from move since onwards."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        return GameHistoryForm(moves=game.history)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        since = max(request.since, 0)
+        moves = game.bind(self.session).history_lines(since)
+        return GameHistoryForm(moves=moves, next_since=since + len(moves))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
+    @with_session
     def get_game(self, request):
         """Return the current game state."""
-        current_user = self._getUser()
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        user_future = self._get_user_async()
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        current_user = user_future.get_result()
+        game = game_future.get_result()
         logging.info(game)
         logging.info(str(current_user))
-        logging.info(game.player1)
-        logging.info(game.player2)
         if game:
-            if current_user.name == game.player1.get(
-            ).name or current_user.name == game.player2.get().name:
+            game.bind(self.session)
+            self.session.get_multi([game.player1, game.player2, game.winner])
+            logging.info(game.player1)
+            logging.info(game.player2)
+            if current_user.key in (game.player1, game.player2):
                 if game.isPlayer1_turn:
                     return game.to_form(
                         'Game Found! Its your move: ' +
-                        game.player1.get().name)
+                        self.session.get(game.player1).name)
                 else:
                     if game.player2:
                         return game.to_form(
                             'Game Found! Its your move: ' +
-                            game.player2.get().name)
+                            self.session.get(game.player2).name)
                     else:
                         return game.to_form(
                             'Still waiting for second player to join.')
@@ -190,84 +489,249 @@ class TicTacToeApi(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    def _check_version(self, urlsafe, version):
+        """Returns a GameVersionForm for a game without touching the
+        datastore unless the version isn't in memcache."""
+        if not endpoints.get_current_user():
+            raise endpoints.UnauthorizedException('Authorization required')
+        current = Game.get_version(urlsafe)
+        if current is None:
+            raise endpoints.NotFoundException('Game not found!')
+        return GameVersionForm(version=current, modified=current != version)
+
+    @endpoints.method(request_message=GAME_VERSION_REQUEST,
+                      response_message=GameVersionForm,
+                      path='game/version/{urlsafe_game_key}',
+                      name='check_game_version',
+                      http_method='GET')
+    @instrumented
+    def check_game_version(self, request):
+        """Cheaply check whether a game changed since version. Clients
+        should only call get_game when modified is true."""
+        return self._check_version(request.urlsafe_game_key, request.version)
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/spectate/{urlsafe_game_key}',
+                      name='spectate_game',
+                      http_method='GET')
+    @instrumented
+    def spectate_game(self, request):
+        """Read-only view of any game, without the passkey. Served from a
+        memcache snapshot that every write to the game refreshes, so
+        spectators normally cost no datastore reads."""
+        form = Game.get_snapshot(request.urlsafe_game_key)
+        if form is None:
+            raise endpoints.NotFoundException('Game not found!')
+        return form
+
+    @endpoints.method(request_message=WAIT_FOR_TURN_REQUEST,
+                      response_message=GameVersionForm,
+                      path='game/wait/{urlsafe_game_key}',
+                      name='wait_for_turn',
+                      http_method='GET')
+    @instrumented
+    def wait_for_turn(self, request):
+        """Long poll: block until a game moves past version or timeout
+        seconds pass, then report its version."""
+        deadline = time.time() + min(max(request.timeout, 0),
+                                     MAX_WAIT_SECONDS)
+        form = self._check_version(request.urlsafe_game_key, request.version)
+        while not form.modified and time.time() < deadline:
+            time.sleep(WAIT_POLL_SECONDS)
+            form = self._check_version(request.urlsafe_game_key,
+                                       request.version)
+        return form
+
     @endpoints.method(request_message=JOIN_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{passcode}',
                       name='join_game',
                       http_method='PUT')
+    @instrumented
+    @rate_limited
+    @with_session
     def join_game(self, request):
         """Join an existing game."""
-        current_user = self._getUser()
+        user_future = self._get_user_async()
+        game_future = get_by_passcode_async(request.passcode, Game)
+        current_user = user_future.get_result()
         logging.info("_getUser: " + str(current_user))
-        game = get_by_passcode(request.passcode, Game)
+        game = game_future.get_result()
         if not game:
             raise endpoints.NotFoundException('Game not found!')
         if game.cancelled:
             raise endpoints.ConflictException('Sorry, this game is over!')
-        if not game.player2:
-            logging.info('Adding player 2')
-            player2 = User.query(User.name == current_user.name).get()
-            if player2.name == game.player1.get().name:
-                raise endpoints.ConflictException(
-                    'You are already in the game!')
-            game.join_game(player2.key)
-            if game.player1 != game.player2:
-                player2.gameKeysPlaying.append(game.key.urlsafe())
-                player2.put()
-            return game.to_form('Welcome to the game!')
-        else:
+        if game.player2:
+            raise endpoints.ConflictException(
+                'Sorry, this game is already in progress!')
+        logging.info('Adding player 2')
+        player2 = current_user
+        if player2.key == game.player1:
+            raise endpoints.ConflictException(
+                'You are already in the game!')
+        # Seated in a transaction, as find_match may be claiming the game.
+        try:
+            game = matchmaking.join(game.key, player2.key)
+        except datastore_errors.TransactionFailedError:
+            game = None
+        if game is None:
             raise endpoints.ConflictException(
                 'Sorry, this game is already in progress!')
+        game = self.session.add(game).bind(self.session)
+        game.with_fields(_form_fields(request))
+        player2.gameKeysPlaying.append(game.key.urlsafe())
+        self.session.mark_dirty(player2)
+        return game.to_form('Welcome to the game!')
+
+    @endpoints.method(response_message=GameForm,
+                      path='match',
+                      name='find_match',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    @with_session
+    def find_match(self, request):
+        """Pairs the user with an open game waiting for an opponent, or
+        opens a new game and queues it for the next player looking."""
+        user = self._getUser()
+        ticket = matchmaking.get_ticket(user.key)
+        if ticket:
+            game = self.session.get(ticket.game)
+            if game and not game.player2 and not game.game_over:
+                return game.bind(self.session).to_form(
+                    'Still waiting for an opponent to join.')
+        game = matchmaking.claim(user.key)
+        if game:
+            self.session.add(game)
+            user.gameKeysPlaying.append(game.key.urlsafe())
+            self.session.mark_dirty(user)
+            return game.bind(self.session).to_form('Welcome to the game!')
+        game = Game.new_game(user.key, [0] * 9, True, True)
+        user.gameKeysPlaying.append(game.key.urlsafe())
+        self.session.mark_dirty(user)
+        matchmaking.enqueue(game)
+        return game.bind(self.session).to_form(
+            'Waiting for an opponent to join.')
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/play/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
+    @rate_limited
+    @with_session
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
+        if request.board < 0:
+            raise endpoints.ConflictException(
+                'You picked an invalid board space!')
+        user_future = self._get_user_async()
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        current_user = user_future.get_result()
+        return self._play(game_future.get_result(), current_user, request,
+                          _form_fields(request))
+
+    @endpoints.method(request_message=BatchMoveForm,
+                      response_message=MoveResultForms,
+                      path='game/play',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    @rate_limited
+    @with_session
+    def make_moves(self, request):
+        """Makes many moves across games at once, for bots and tournament
+        runners. Every game and player is fetched in one batch and all
+        results are committed together. Returns the outcome of each
+        move in order; a refused move doesn't stop the others."""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves per batch!'.format(MAX_BATCH_MOVES))
+        fields = _form_fields(request)
         current_user = self._getUser()
-        if request.board < 0 or request.board > 8:
+        keys = {}
+        for move in request.moves:
+            try:
+                keys[move.urlsafe_game_key] = key_from_urlsafe(
+                    move.urlsafe_game_key)
+            except endpoints.BadRequestException:
+                keys[move.urlsafe_game_key] = None
+        games = dict(zip(keys, self.session.get_multi(keys.values())))
+        self.session.get_multi([player for game in games.values()
+                                if isinstance(game, Game)
+                                for player in (game.player1, game.player2)])
+        results = MoveResultForms()
+        for move in request.moves:
+            result = MoveResultForm(urlsafe_game_key=move.urlsafe_game_key,
+                                    board=move.board)
+            game = games[move.urlsafe_game_key]
+            try:
+                if keys[move.urlsafe_game_key] is None:
+                    raise endpoints.BadRequestException('Invalid Key')
+                if game is not None and not isinstance(game, Game):
+                    raise endpoints.BadRequestException('Incorrect Kind')
+                result.game = self._play(game, current_user, move, fields)
+            except endpoints.ServiceException as e:
+                result.error = str(e)
+            results.items.append(result)
+        return results
+
+    def _play(self, game, current_user, move, fields=None):
+        """Validates a move with the game's rules, plays it and checks
+        for a result. Returns the new game state."""
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if move.board < 0 or move.board >= len(game.board):
             raise endpoints.ConflictException(
                 'You picked an invalid board space!')
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        move = game.is_move_legal(current_user, request)
-        game.board[request.board] = move
-        game.update_board(game.board)
-        game.update_history(move, request.board)
+        game.bind(self.session).with_fields(fields)
+        player = game.is_move_legal(current_user, move)
+        game.update_board(player, move.board)
+        game.update_history(player, move.board)
         game.pass_turn()
-        return game.is_victory_achieved()
+        form = game.is_victory_achieved(move.board)
+        if game.is_computer_turn():
+            form = game.play_computer_move()
+        return form
 
     @endpoints.method(request_message=CANCEL_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
+    @rate_limited
+    @with_session
     def cancel_game(self, request):
         """Cancel a game currently in progress"""
-        current_user = self._getUser()
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        user_future = self._get_user_async()
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        current_user = user_future.get_result()
+        game = game_future.get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        game.bind(self.session).with_fields(_form_fields(request))
         logging.info(game.player2)
-        if not game.player2:
-            if current_user.name != game.player1.get().name:
-                raise endpoints.UnauthorizedException(
-                    "You are not a member of this game, you can't cancel it!")
-        else:
-            if current_user.name != game.player1.get().name and\
-                    current_user.name != game.player2.get().name:
-                raise endpoints.UnauthorizedException(
-                    "You are not a member of this game, you can't cancel it!")
+        if current_user.key not in (game.player1, game.player2):
+            raise endpoints.UnauthorizedException(
+                "You are not a member of this game, you can't cancel it!")
         if game.game_over:
             raise endpoints.ConflictException(
                 "This game is already over! It can't be cancelled!")
         game.cancelled = True
         game.game_over = True
-        game.player1.get().gameKeysPlaying.remove(game.key.urlsafe())
-        game.player1.get().put()
-        if game.player2:
-            game.player2.get().gameKeysPlaying.remove(game.key.urlsafe())
-            game.player2.get().put()
-        game.put()
+        players = self.session.get_multi([game.player1, game.player2])
+        for player in players:
+            if player is not None:
+                if player.is_computer:
+                    continue
+                player.gameKeysPlaying.remove(game.key.urlsafe())
+                self.session.mark_dirty(player)
+        if game.player2 is not None:
+            game.record_stats(players[0], players[1], stats.CANCELLED)
+        game.save()
         return game.to_form("Game Cancelled!")
 
 api = endpoints.api_server([TicTacToeApi])
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local load and latency benchmark for TicTacToeApi.
+
+Runs the API in process against the App Engine testbed stubs (datastore,
+memcache, users, task queue, mail and urlfetch) and drives a scripted
+workload through the endpoints: users are created, pair up in games that
+are joined by passcode, play them out move by move while polling
+get_game, check the rankings and cancel some games. Finally the same
+number of games is provisioned again in one new_games call, so its cost
+per game can be set against new_game's. For every endpoint it
+reports throughput, p50/p95/p99 latency, datastore gets, puts and
+queries per call, memcache traffic per call, and the size of the entities
+written, as JSON so runs can be compared between versions.
+
+Usage:
+    python benchmark.py --sdk PATH_TO_GOOGLE_APPENGINE [--users N]
+        [--games N] [--polls N] [--seed N] [--output FILE]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+PERCENTILES = (50, 95, 99)
+
+
+class RpcCounter(object):
+    """Counts API calls and datastore bytes through an apiproxy hook."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def hook(self, service, call, request, response):
+        self.counts['{0}.{1}'.format(service, call)] += 1
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            self.counts['datastore_v3.Get.keys'] += request.key_size()
+            self.counts['datastore_v3.Get.bytes'] += response.ByteSize()
+        elif call == 'Put':
+            self.counts['datastore_v3.Put.entities'] += \
+                request.entity_size()
+            self.counts['datastore_v3.Put.bytes'] += sum(
+                entity.ByteSize() for entity in request.entity_list())
+
+
+class Benchmark(object):
+    """Calls endpoints as a given user and records per-call metrics."""
+
+    def __init__(self, api, rpcs):
+        self.api = api
+        self.rpcs = rpcs
+        self.latencies = collections.defaultdict(list)
+        self.totals = collections.defaultdict(collections.Counter)
+        self.errors = collections.Counter()
+        self.crashes = collections.Counter()
+        # The first traceback of each endpoint that crashed.
+        self.tracebacks = {}
+
+    def call(self, user, name, request):
+        """Invokes endpoint name as user. Returns its response, or None
+        if it raised. ServiceExceptions are counted as errors; anything
+        else is a crash, counted and reported with its traceback, so one
+        broken endpoint doesn't stop the run or hide the others."""
+        import endpoints
+        from google.appengine.ext import ndb
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = user
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+        # Each call is a new request, with an empty ndb context cache.
+        ndb.get_context().clear_cache()
+        self.rpcs.counts.clear()
+        service = self.api()
+        start = time.time()
+        try:
+            response = getattr(service, name)(request)
+        except endpoints.ServiceException:
+            response = None
+            self.errors[name] += 1
+        except Exception:
+            response = None
+            self.crashes[name] += 1
+            if name not in self.tracebacks:
+                self.tracebacks[name] = traceback.format_exc()
+                sys.stderr.write(self.tracebacks[name])
+        self.latencies[name].append(time.time() - start)
+        self.totals[name].update(self.rpcs.counts)
+        return response
+
+    def report(self):
+        """Returns the collected metrics keyed by endpoint name."""
+        results = {}
+        for name, latencies in sorted(self.latencies.items()):
+            calls = len(latencies)
+            ordered = sorted(latencies)
+            total = self.totals[name]
+            result = {
+                'calls': calls,
+                'errors': self.errors[name],
+                'crashes': self.crashes[name],
+                'throughput_per_s': round(calls / sum(latencies), 1)
+                if sum(latencies) else None,
+            }
+            for percentile in PERCENTILES:
+                index = min(calls - 1, int(calls * percentile / 100.0))
+                result['p{0}_ms'.format(percentile)] = round(
+                    ordered[index] * 1e3, 3)
+            for key, value in sorted(total.items()):
+                result[key + '_per_call'] = round(float(value) / calls, 2)
+            if name in self.tracebacks:
+                result['traceback'] = self.tracebacks[name]
+            results[name] = result
+        return results
+
+
+def setup_testbed(sdk):
+    """Activates the testbed stubs and returns (TicTacToeApi, testbed,
+    RpcCounter). Also used by the counter and matchmaking load tests."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(
+        os.path.abspath(__file__)))
+    bed.init_mail_stub()
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+
+    rpcs = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'benchmark', rpcs.hook)
+    from api import TicTacToeApi
+    import ratelimit
+    # The workload replays calls far faster than any player would.
+    ratelimit.LIMITS.clear()
+    return TicTacToeApi, bed, rpcs
+
+
+def _request(container, **fields):
+    return container.combined_message_class(**fields)
+
+
+def run(sdk, users=20, games=50, polls=3, seed=0):
+    """Runs the scripted workload and returns the metrics report."""
+    api_class, bed, rpcs = setup_testbed(sdk)
+    import api
+    from protorpc import message_types
+    from models.game import BulkGameForm, PairingForm
+    rng = random.Random(seed)
+    bench = Benchmark(api_class, rpcs)
+    void = message_types.VoidMessage()
+    emails = ['player{0}@example.com'.format(i) for i in range(users)]
+    api.ORGANISERS.add(emails[0])
+    try:
+        for email in emails:
+            bench.call(email, 'create_user', void)
+        for game_number in range(games):
+            player1, player2 = rng.sample(range(users), 2)
+            by_passcode = game_number % 2 == 0
+            new_game = bench.call(emails[player1], 'new_game', _request(
+                api.NEW_GAME_REQUEST, isPlayer1_X=True,
+                player2_name=None if by_passcode else emails[player2]))
+            if not new_game:
+                continue
+            key = new_game.urlsafe_key
+            if by_passcode:
+                bench.call(emails[player2], 'join_game', _request(
+                    api.JOIN_GAME_REQUEST, passcode=new_game.passkey,
+                    passkey=new_game.passkey))
+            if game_number % 10 == 9:
+                bench.call(emails[player1], 'cancel_game', _request(
+                    api.CANCEL_GAME_REQUEST, urlsafe_game_key=key))
+                continue
+            squares = range(len(new_game.board))
+            rng.shuffle(squares)
+            movers = [emails[player1], emails[player2]]
+            for turn, square in enumerate(squares):
+                for _ in range(polls):
+                    bench.call(movers[turn % 2], 'get_game', _request(
+                        api.GET_GAME_REQUEST, urlsafe_game_key=key))
+                form = bench.call(movers[turn % 2], 'make_move', _request(
+                    api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+                    board=square))
+                if form is None or form.game_over:
+                    break
+            bench.call(movers[0], 'get_game_history', _request(
+                api.GAME_HISTORY_REQUEST, urlsafe_game_key=key))
+            bench.call(movers[0], 'get_user_games', void)
+            bench.call(movers[0], 'get_user_rankings', _request(
+                api.RANKINGS_REQUEST))
+        pairings = []
+        for _ in range(games):
+            player1, player2 = rng.sample(range(users), 2)
+            pairings.append(PairingForm(player1_name=emails[player1],
+                                        player2_name=emails[player2]))
+        bench.call(emails[0], 'new_games', BulkGameForm(pairings=pairings))
+    finally:
+        bed.deactivate()
+    return bench.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the google_appengine SDK')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--polls', type=int, default=3,
+                        help='get_game calls before each move')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+    report = json.dumps(run(args.sdk, args.users, args.games, args.polls,
+                            args.seed), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
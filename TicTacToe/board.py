@@ -0,0 +1,126 @@
+"""board.py - Bitboard win detection for N x N boards with k-in-a-row
+rules. Each player's tiles are kept as one integer mask, bit i standing
+for board square i, so a win check is a handful of AND operations over
+the precomputed lines that pass through the square just played."""
+
+_RULES = {}
+
+
+class BoardRules(object):
+    """Precomputed line masks for an N x N board where k tiles in a row
+    (horizontally, vertically or diagonally) win the game."""
+
+    def __init__(self, size=3, win_length=3):
+        if not 1 <= win_length <= size:
+            raise ValueError("win_length must be between 1 and size")
+        self.size = size
+        self.win_length = win_length
+        self.squares = size * size
+        self.full_mask = (1 << self.squares) - 1
+        self.lines = self._build_lines()
+        # Only the lines through the last move can have been completed by
+        # it, at most 4 * win_length of them.
+        self.lines_through = [[line for line in self.lines
+                               if line & (1 << square)]
+                              for square in xrange(self.squares)]
+
+    def _build_lines(self):
+        """Returns the mask of every k-long run on the board."""
+        lines = []
+        size, k = self.size, self.win_length
+        for row in xrange(size):
+            for col in xrange(size):
+                for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_row = row + d_row * (k - 1)
+                    end_col = col + d_col * (k - 1)
+                    if not (0 <= end_row < size and 0 <= end_col < size):
+                        continue
+                    mask = 0
+                    for step in xrange(k):
+                        square = (row + d_row * step) * size + \
+                            col + d_col * step
+                        mask |= 1 << square
+                    lines.append(mask)
+        return lines
+
+    def masks_from_board(self, board):
+        """Returns (player1_mask, player2_mask) for a list board of 0, 1
+        and 2 values."""
+        player1_mask = player2_mask = 0
+        for square, tile in enumerate(board):
+            if tile == 1:
+                player1_mask |= 1 << square
+            elif tile == 2:
+                player2_mask |= 1 << square
+        return player1_mask, player2_mask
+
+    def is_win(self, mask, square):
+        """Checks whether the tile just played on square completed a line
+        for the player owning mask."""
+        for line in self.lines_through[square]:
+            if mask & line == line:
+                return True
+        return False
+
+    def is_full(self, player1_mask, player2_mask):
+        """Checks whether every square on the board has been played."""
+        return player1_mask | player2_mask == self.full_mask
+
+
+def get_rules(size=3, win_length=3):
+    """Returns the shared BoardRules for a board size and win length."""
+    key = (size, win_length)
+    if key not in _RULES:
+        _RULES[key] = BoardRules(size, win_length)
+    return _RULES[key]
+
+
+def _list_victory(board):
+    """The list based 3x3 check Game.is_victory_achieved used before
+    bitboards, kept for the benchmark below."""
+    victory_conditions = [[board[0], board[1], board[2]],
+                          [board[3], board[4], board[5]],
+                          [board[6], board[7], board[8]],
+                          [board[0], board[3], board[6]],
+                          [board[1], board[4], board[7]],
+                          [board[2], board[5], board[8]],
+                          [board[0], board[4], board[8]],
+                          [board[2], board[4], board[6]]]
+    for victory in victory_conditions:
+        if victory.count(victory[0]) == len(victory) and victory[0]:
+            return victory[0]
+        if all(v != 0 for v in board):
+            return 0
+    return None
+
+
+def benchmark(number=100000):
+    """Compares the list based check with the bitboard check on a 3x3
+    board, then times the bitboard check on larger boards."""
+    import timeit
+    board = [1, 2, 1,
+             2, 1, 2,
+             0, 0, 0]
+    rules = get_rules()
+    player1_mask, player2_mask = rules.masks_from_board(board)
+    results = [
+        ('list 3x3', timeit.timeit(lambda: _list_victory(board),
+                                   number=number)),
+        ('bitboard 3x3', timeit.timeit(
+            lambda: (rules.is_win(player1_mask, 4) or
+                     rules.is_full(player1_mask, player2_mask)),
+            number=number))]
+    for size, win_length in ((7, 5), (15, 5), (19, 5)):
+        rules = get_rules(size, win_length)
+        square = rules.squares // 2
+        results.append(('bitboard {0}x{0} k={1}'.format(size, win_length),
+                        timeit.timeit(lambda: rules.is_win(1 << square,
+                                                           square),
+                                      number=number)))
+    for name, seconds in results:
+        print '{0:<22}{1:.3f} us/check'.format(name,
+                                               seconds / number * 1e6)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""counter_stress.py - Concurrency stress test for the sharded counters.
+
+Runs many counter.increment_async() calls on one player's stat at once,
+from several threads, against the App Engine testbed datastore and
+memcache stubs, so the shard transactions contend and retry. Then checks
+that no increment was lost: the total read by counter.get_totals() must
+equal the number of increments that succeeded, both from memcache and,
+after a memcache flush, summed from the shards. Increments that fail
+after ndb's retries raise to their caller and are reported separately.
+Prints the results as JSON and exits non-zero if a count is wrong.
+
+Usage:
+    python counter_stress.py --sdk PATH_TO_GOOGLE_APPENGINE
+        [--increments N] [--threads N]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from benchmark import setup_testbed
+
+
+def _increment(user_key, stat, number, results):
+    """Issues number concurrent increments and records how many of them
+    succeeded and failed."""
+    from google.appengine.ext import ndb
+    from models import counter
+    futures = [counter.increment_async(user_key, stat)
+               for _ in xrange(number)]
+    ndb.Future.wait_all(futures)
+    failed = sum(1 for future in futures if future.get_exception())
+    results.append((number - failed, failed))
+
+
+def run(sdk, increments=1000, threads=4):
+    """Runs the stress test and returns its report."""
+    bed = setup_testbed(sdk)[1]
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    from models import counter
+    user_key = ndb.Key('User', 'stress@example.com')
+    stat = 'wins'
+    try:
+        # Cache the zero total first, so increments go through incr().
+        counter.get_totals([user_key])
+        results = []
+        workers = [threading.Thread(
+            target=_increment,
+            args=(user_key, stat, increments // threads +
+                  (i < increments % threads), results))
+            for i in xrange(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        succeeded = sum(ok for ok, _ in results)
+        failed = sum(failures for _, failures in results)
+        cached = counter.get_totals([user_key])[user_key][stat]
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+        summed = counter.get_totals([user_key])[user_key][stat]
+    finally:
+        bed.deactivate()
+    return {
+        'increments': increments,
+        'threads': threads,
+        'shards': counter.NUM_SHARDS,
+        'succeeded': succeeded,
+        'failed': failed,
+        'total_from_memcache': cached,
+        'total_from_shards': summed,
+        'increments_per_s': round(increments / elapsed, 1),
+        'lost': succeeded - summed,
+        'ok': cached == summed == succeeded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the google_appengine SDK')
+    parser.add_argument('--increments', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    report = run(args.sdk, args.increments, args.threads)
+    print json.dumps(report, indent=2, sort_keys=True)
+    if not report['ok']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
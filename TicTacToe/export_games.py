@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""export_games.py - Offline export of finished games to NDJSON.
+
+Streams every Game with game_over set, then every ArchivedGame, one
+cursor page at a time, over remote_api and writes one JSON object per
+line (see Game.export_record). Games archived while an export runs may
+be missed or written twice.
+
+Only one page is held in memory, so the export runs in constant memory
+however many games are stored. The cursor after each page is written to
+a checkpoint file with the kind being read, and passing --resume
+continues from it. A page that was interrupted before its checkpoint was
+written is exported again.
+
+Usage:
+    python export_games.py [--host HOST] [--resume] OUTPUT
+"""
+
+import argparse
+import getpass
+import json
+import os
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext.remote_api import remote_api_stub
+
+PAGE_SIZE = 500
+
+
+def _auth():
+    return raw_input('Email: '), getpass.getpass('Password: ')
+
+
+def export(output, resume=False, page_size=PAGE_SIZE):
+    """Appends finished games to output, returning how many were written."""
+    from models.game import Game, ArchivedGame
+    queries = [('Game', Game.query(Game.game_over == True)),
+               ('ArchivedGame', ArchivedGame.query())]
+    checkpoint = output + '.cursor'
+    start_kind, cursor = None, None
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            start_kind, _, urlsafe = f.read().strip().partition(' ')
+        if not urlsafe:
+            # Checkpoints from before archiving hold only a Game cursor.
+            start_kind, urlsafe = 'Game', start_kind
+        cursor = Cursor(urlsafe=urlsafe)
+    written = 0
+    with open(output, 'a' if resume else 'w') as out:
+        for kind, query in queries:
+            if start_kind and kind != start_kind:
+                continue
+            start_kind = None
+            more = True
+            while more:
+                entities, cursor, more = query.fetch_page(
+                    page_size, start_cursor=cursor)
+                for entity in entities:
+                    game = entity if kind == 'Game' else entity.to_game()
+                    out.write(json.dumps(game.export_record()) + '\n')
+                out.flush()
+                written += len(entities)
+                if cursor:
+                    with open(checkpoint, 'w') as f:
+                        f.write('{0} {1}'.format(kind, cursor.urlsafe()))
+            cursor = None
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('output')
+    parser.add_argument('--host', default='localhost:8080')
+    parser.add_argument('--resume', action='store_true')
+    args = parser.parse_args()
+    remote_api_stub.ConfigureRemoteApi(None, '/_ah/remote_api', _auth,
+                                       args.host)
+    print '{0} games exported'.format(export(args.output, args.resume))
+
+
+if __name__ == '__main__':
+    main()
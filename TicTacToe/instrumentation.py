@@ -0,0 +1,146 @@
+"""instrumentation.py - Per-request RPC and timing instrumentation.
+
+An apiproxy hook attributes every datastore and memcache call to the
+request running on the current thread. Endpoints wrapped with
+instrumented() record their wall time, datastore get/put/query counts
+and bytes, memcache hits and misses, and the time spent in sections
+marked with timed(). The records are folded into per-endpoint latency
+histograms kept in process memory; snapshot() returns them for the
+admin stats handler. Requests slower than SLOW_REQUEST_MS are logged."""
+
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+SLOW_REQUEST_MS = 1000
+# Upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_installed = []
+
+
+def _hook(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            _add(counts, 'datastore_gets', request.key_size())
+            _add(counts, 'datastore_get_bytes', response.ByteSize())
+        elif call == 'Put':
+            _add(counts, 'datastore_puts', request.entity_size())
+            _add(counts, 'datastore_put_bytes', request.ByteSize())
+        elif call == 'RunQuery':
+            _add(counts, 'datastore_queries', 1)
+            _add(counts, 'datastore_query_bytes', response.ByteSize())
+        elif call == 'Next':
+            _add(counts, 'datastore_query_bytes', response.ByteSize())
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        _add(counts, 'memcache_hits', hits)
+        _add(counts, 'memcache_misses', request.key_size() - hits)
+
+
+def _add(counts, name, value):
+    counts[name] = counts.get(name, 0) + value
+
+
+def install():
+    """Registers the RPC hook. Safe to call more than once."""
+    with _lock:
+        if not _installed:
+            apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+                'instrumentation', _hook)
+            _installed.append(True)
+
+
+def count(name, value=1):
+    """Adds value to a named count of the current request."""
+    counts = getattr(_local, 'counts', None)
+    if counts is not None:
+        _add(counts, name, value)
+
+
+def timed(section):
+    """Decorator adding a function's run time to the current request's
+    section timings. Nested sections are each timed in full."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            counts = getattr(_local, 'counts', None)
+            if counts is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _add(counts, section + '_ms', (time.time() - start) * 1e3)
+        return wrapper
+    return decorator
+
+
+def instrumented(func):
+    """Decorator recording an endpoint's per-request metrics."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        install()
+        _local.counts = counts = {}
+        start = time.time()
+        try:
+            return func(self, request)
+        finally:
+            _local.counts = None
+            _record(func.__name__, (time.time() - start) * 1e3, counts)
+    return wrapper
+
+
+def _record(name, elapsed_ms, counts):
+    if elapsed_ms >= SLOW_REQUEST_MS:
+        logging.warning('Slow request %s: %.0f ms %s', name, elapsed_ms,
+                        counts)
+    bucket = len(BUCKETS_MS)
+    for i, bound in enumerate(BUCKETS_MS):
+        if elapsed_ms <= bound:
+            bucket = i
+            break
+    with _lock:
+        stats = _stats.setdefault(name, {
+            'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'histogram': [0] * (len(BUCKETS_MS) + 1), 'totals': {}})
+        stats['requests'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['histogram'][bucket] += 1
+        for key, value in counts.items():
+            _add(stats['totals'], key, value)
+
+
+def snapshot():
+    """Returns a copy of this instance's per-endpoint statistics."""
+    with _lock:
+        result = {}
+        for name, stats in _stats.items():
+            requests = stats['requests']
+            result[name] = {
+                'requests': requests,
+                'mean_ms': round(stats['total_ms'] / requests, 3),
+                'max_ms': round(stats['max_ms'], 3),
+                'histogram_ms': dict(
+                    ('<={0}'.format(bound), count) for bound, count in
+                    zip(BUCKETS_MS + ('inf',), stats['histogram'])),
+                'per_request': dict(
+                    (key, round(value / float(requests), 3))
+                    for key, value in stats['totals'].items())}
+        return result
+
+
+def reset():
+    """Clears this instance's statistics."""
+    with _lock:
+        _stats.clear()
@@ -2,30 +2,237 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import datetime
+import json
+import logging
+import time
 import webapp2
-from google.appengine.api import mail, app_identity
-from models.user import User
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from models.user import User, COMPUTER_ID
+from models.game import Game, ArchivedGame
+from models import counter, leaderboard, stats
+import instrumentation
+
+MIGRATION_BATCH_SIZE = 200
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_AFTER_DAYS = 30
+# (board_size, win_length) of the boards whose rules and solver tables
+# are built before an instance takes traffic.
+WARMUP_BOARDS = ((3, 3),)
+REMINDER_BATCH_SIZE = 100
+REMINDER_QUEUE = 'reminders'
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
     def get(self):
         """Send a reminder email to each User with an email and active games.
-        Called every 24 hours using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(
-            User.email != None and User.gameKeysPlaying != None)
+        Called every 24 hours using a cron job. The cron only starts the
+        run; the users are paged through and mailed by task queue tasks
+        so that the run finishes whatever the number of users."""
+        run = datetime.datetime.utcnow().strftime('%Y%m%d')
+        _enqueue_reminders([_reminder_page_task(run, 0)])
+
+
+class SendReminderPage(webapp2.RequestHandler):
+
+    def post(self):
+        """Read one page of users due a reminder, hand it to a send task
+        and chain the task for the next page. The cursor carried from
+        task to task is the checkpoint a failed run resumes from."""
+        run = self.request.get('run')
+        page = int(self.request.get('page'))
+        cursor = self.request.get('cursor')
+        keys, next_cursor, more = User.query(
+            User.needs_reminder == True).fetch_page(
+                REMINDER_BATCH_SIZE, keys_only=True,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        tasks = []
+        if keys:
+            tasks.append(taskqueue.Task(
+                url='/tasks/reminders/send',
+                name='reminders-{0}-{1}-send'.format(run, page),
+                params={'key': [key.urlsafe() for key in keys]}))
+        if more and next_cursor:
+            tasks.append(_reminder_page_task(run, page + 1,
+                                             next_cursor.urlsafe()))
+        _enqueue_reminders(tasks)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+
+    def post(self):
+        """Send reminders to one batch of users."""
+        sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
+        users = ndb.get_multi([ndb.Key(urlsafe=urlsafe)
+                               for urlsafe in self.request.get_all('key')])
         for user in users:
+            if not user or not user.needs_reminder:
+                continue
             subject = 'This is a reminder!'
             body = """Hello {0}, You currently have active games that you are still playing!\n
                       You are still
                       playing {1} games.""".format(user.name,
                                                    len(user.gameKeysPlaying))
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+            mail.send_mail(sender, user.email, subject, body)
+
+
+def _reminder_page_task(run, page, cursor=''):
+    return taskqueue.Task(url='/tasks/reminders/page',
+                          name='reminders-{0}-{1}'.format(run, page),
+                          params={'run': run, 'page': page,
+                                  'cursor': cursor})
+
+
+def _enqueue_reminders(tasks):
+    """Add tasks to the reminders queue. Tasks are named after the run
+    and page, so a retried handler cannot start a page twice."""
+    if not tasks:
+        return
+    try:
+        taskqueue.Queue(REMINDER_QUEUE).add(tasks)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError,
+            taskqueue.DuplicateTaskNameError):
+        logging.info('Reminder tasks already queued: %s',
+                     [task.name for task in tasks])
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+
+    def get(self):
+        """Carry every User's old inline counts over to the sharded
+        counters, recompute and index its score, then rebuild the rank
+        histogram from those scores. Run once after upgrading, and again
+        if the histogram ever drifts. The computer player isn't ranked."""
+        leaderboard.rebuild(self._scores())
+
+    def _scores(self):
+        cursor, more = None, True
+        while more:
+            users, cursor, more = User.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+            users = [user for user in users if not user.is_computer]
+            counter.seed_legacy(users)
+            totals = counter.get_totals([user.key for user in users])
+            for user in users:
+                user.update_score(totals[user.key])
+            ndb.put_multi(users)
+            for user in users:
+                yield user.score
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+
+    def get(self):
+        """Rekey Users created with datastore allocated ids so that they
+        are keyed by name, repointing their games, stat shards, streaks
+        and head-to-head records. Users already keyed by name are left
+        alone, so this can be rerun."""
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = User.query().fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            for key in keys:
+                if isinstance(key.id(), (int, long)):
+                    self._rekey(key.get())
+
+    def _rekey(self, user):
+        old_key = user.key
+        new_user = User(id=user.name,
+                        **user.to_dict(exclude=['needs_reminder']))
+        games = Game.query(ndb.OR(Game.player1 == old_key,
+                                  Game.player2 == old_key,
+                                  Game.winner == old_key)).fetch()
+        # The winner of an archived game is always one of its players.
+        games += ArchivedGame.query(ndb.OR(
+            ArchivedGame.player1 == old_key,
+            ArchivedGame.player2 == old_key)).fetch()
+        for game in games:
+            for prop in ('player1', 'player2', 'winner'):
+                if getattr(game, prop) == old_key:
+                    setattr(game, prop, new_user.key)
+        shards, old_shard_keys = counter.move_shards(old_key, new_user.key)
+        records, old_record_keys = stats.move_stats(old_key, new_user.key)
+        ndb.put_multi([new_user] + games + shards + records)
+        ndb.delete_multi([old_key] + old_shard_keys + old_record_keys)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+
+    def get(self):
+        """Move finished games last written more than ARCHIVE_AFTER_DAYS
+        (or ?days=N) days ago into the compact ArchivedGame kind, a page
+        at a time. Only old games are read, through the game_over and
+        modified index. Games saved before Game.modified was indexed
+        aren't in that index; run once with ?legacy=1 to scan every
+        finished game for them instead. Each page is archived before its
+        games are deleted, so a failed run loses nothing and is simply run
+        again. Called daily by cron."""
+        days = int(self.request.get('days', ARCHIVE_AFTER_DAYS))
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        if self.request.get('legacy'):
+            query = Game.query(Game.game_over == True)
+        else:
+            query = Game.query(Game.game_over == True,
+                               Game.modified < cutoff)
+        archived, cursor, more = 0, None, True
+        while more:
+            games, cursor, more = query.fetch_page(ARCHIVE_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            old = [game for game in games
+                   if game.modified is None or game.modified < cutoff]
+            if old:
+                ndb.put_multi([ArchivedGame.from_game(game) for game in old])
+                ndb.delete_multi([game.key for game in old])
+                archived += len(old)
+        logging.info('Archived %d games', archived)
+
+
+class Warmup(webapp2.RequestHandler):
+
+    def get(self):
+        """Load the API and the tables it builds on first use, and prime
+        memcache with the objects most requests read, so a new instance's
+        first user request doesn't pay for them. App Engine calls this
+        before sending traffic to a new instance."""
+        start = time.time()
+        import api
+        import solver
+        for size, win_length in WARMUP_BOARDS:
+            solver.get_solver(size, win_length)
+        instrumentation.install()
+        # A plain get fills ndb's memcache, which the transaction in
+        # get_or_insert would not.
+        if User.get_by_id(COMPUTER_ID) is None:
+            User.computer()
+        leaderboard.rank_of(0)
+        api.rankings_page(api.DEFAULT_RANKINGS_PAGE)
+        logging.info('Warmed up in %.0f ms', (time.time() - start) * 1e3)
+
+
+class RequestStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Return this instance's per-endpoint request statistics as
+        JSON. Pass reset=1 to clear them afterwards."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.snapshot(),
+                                       indent=2, sort_keys=True))
+        if self.request.get('reset'):
+            instrumentation.reset()
+
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/reminders/page', SendReminderPage),
+    ('/tasks/reminders/send', SendReminderBatch),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/admin/stats', RequestStats),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
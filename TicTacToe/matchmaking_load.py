@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""matchmaking_load.py - Load test of find_match under concurrent joins.
+
+Queues a number of open games, then starts many players looking for a
+match at the same moment, one thread each, against the App Engine
+testbed stubs. Each player runs find_match's steps: claim a queued game,
+or open and queue a new one. Reports the match rate (the share of
+players who joined a game rather than opening one), the tickets skipped
+because another player's claim transaction won, per-call latency, and
+whether any game was joined twice. Prints the results as JSON and exits
+non-zero if a game was double-joined.
+
+Usage:
+    python matchmaking_load.py --sdk PATH_TO_GOOGLE_APPENGINE
+        [--open N] [--players N]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from benchmark import setup_testbed
+
+
+def find_match(self, user_key):
+    """find_match's matchmaking steps for one player: claims a queued
+    game, or opens and queues a new one. Returns the claimed game or None.
+    Takes self like the endpoint, so instrumentation.instrumented can
+    record it under the same name."""
+    from models import matchmaking
+    from models.game import Game
+    game = matchmaking.claim(user_key)
+    if game is None:
+        matchmaking.enqueue(Game.new_game(user_key, [0] * 9, True, True))
+    return game
+
+
+def _join(find_match, user_key, start, games):
+    start.wait()
+    games[user_key] = find_match(None, user_key)
+
+
+def run(sdk, open_games=100, players=100):
+    """Runs the load test and returns its report."""
+    bed = setup_testbed(sdk)[1]
+    from google.appengine.ext import ndb
+    import instrumentation
+    from models import matchmaking
+    from models.game import Game
+    try:
+        for i in xrange(open_games):
+            matchmaking.enqueue(Game.new_game(
+                ndb.Key('User', 'host{0}@example.com'.format(i)), [0] * 9,
+                True, True))
+        instrumentation.reset()
+        timed_find_match = instrumentation.instrumented(find_match)
+        user_keys = [ndb.Key('User', 'player{0}@example.com'.format(i))
+                     for i in xrange(players)]
+        games = {}
+        start = threading.Event()
+        threads = [threading.Thread(target=_join, args=(
+            timed_find_match, user_key, start, games))
+            for user_key in user_keys]
+        for thread in threads:
+            thread.start()
+        began = time.time()
+        start.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - began
+        joined = [(user_key, game) for user_key, game in games.items()
+                  if game]
+        stored = ndb.get_multi([game.key for _, game in joined])
+        # A game is double-joined if two players were told they joined
+        # it, or if its stored player 2 isn't the player who joined it.
+        double_joins = len(joined) - len(set(
+            game.key for game, (user_key, _) in zip(stored, joined)
+            if game.player2 == user_key))
+        queued = matchmaking.MatchTicket.query().count()
+        stats = instrumentation.snapshot().get('find_match', {})
+    finally:
+        bed.deactivate()
+    per_request = stats.get('per_request', {})
+    return {
+        'open_games': open_games,
+        'players': players,
+        'matched': len(joined),
+        'match_rate': round(len(joined) / float(players), 3)
+        if players else None,
+        'contention_skips': int(round(
+            per_request.get('match_contention', 0) * players)),
+        'double_joins': double_joins,
+        'queued_after': queued,
+        'elapsed_s': round(elapsed, 3),
+        'mean_ms': stats.get('mean_ms'),
+        'max_ms': stats.get('max_ms'),
+        'datastore_queries_per_call': per_request.get('datastore_queries'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the google_appengine SDK')
+    parser.add_argument('--open', type=int, default=100,
+                        help='games queued before the players arrive')
+    parser.add_argument('--players', type=int, default=100)
+    args = parser.parse_args()
+    report = run(args.sdk, args.open, args.players)
+    print json.dumps(report, indent=2, sort_keys=True)
+    if report['double_joins']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
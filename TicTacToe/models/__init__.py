@@ -1 +1,2 @@
-__all__ = ['user', 'game']
\ No newline at end of file
+__all__ = ['user', 'game', 'session', 'leaderboard', 'counter',
+           'matchmaking', 'stats']
\ No newline at end of file
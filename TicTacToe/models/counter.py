@@ -0,0 +1,114 @@
+"""counter.py - Sharded win, loss and draw counters for players.
+
+Each increment runs in a small transaction on one randomly chosen shard
+entity, so a player finishing many games at once never contends on, or
+loses updates to, a single entity. Totals are summed from the shards and
+kept in memcache, where increments are applied as they happen."""
+
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+STATS = ('wins', 'losses', 'draws')
+NUM_SHARDS = 5
+# Counts carried over from the old User.wins/losses/draws properties.
+LEGACY_SHARD = 'legacy'
+CACHE_KEY = 'stat:{0}:{1}'
+# Bounds how long a total rebuilt alongside a missed incr() can lag.
+CACHE_TTL = 600
+
+
+class StatShard(ndb.Model):
+    """One shard of one player's counter for one stat."""
+    count = ndb.IntegerProperty(indexed=False, default=0)
+
+
+def _shard_key(user_key, stat, shard):
+    return ndb.Key(StatShard, '{0}|{1}|{2}'.format(user_key.id(), stat,
+                                                    shard))
+
+
+def _shard_keys(user_key, stat):
+    return [_shard_key(user_key, stat, shard)
+            for shard in range(NUM_SHARDS) + [LEGACY_SHARD]]
+
+
+def _cache_key(user_key, stat):
+    return CACHE_KEY.format(user_key.urlsafe(), stat)
+
+
+@ndb.transactional_tasklet
+def _increment_shard_async(key, delta):
+    shard = (yield key.get_async()) or StatShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def increment_async(user_key, stat, delta=1):
+    """Adds delta to one of a player's stats. Returns a Future."""
+    shard = random.randint(0, NUM_SHARDS - 1)
+    yield _increment_shard_async(_shard_key(user_key, stat, shard), delta)
+    # A missing cache entry is left alone; the next read rebuilds it.
+    yield ndb.get_context().memcache_incr(_cache_key(user_key, stat), delta)
+
+
+def increment(user_key, stat, delta=1):
+    """Adds delta to one of a player's stats."""
+    increment_async(user_key, stat, delta).get_result()
+
+
+def increment_multi(changes):
+    """Applies (user_key, stat) increments of one concurrently. Each runs
+    in its own transaction, so they all take about as long as one."""
+    futures = [increment_async(user_key, stat) for user_key, stat in changes]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+def get_totals(user_keys):
+    """Returns {user_key: {stat: total}} for the given players, reading
+    memcache first and summing the shards of anything missing."""
+    cache_keys = dict(((user_key, stat), _cache_key(user_key, stat))
+                      for user_key in user_keys for stat in STATS)
+    cached = memcache.get_multi(cache_keys.values())
+    missing = [pair for pair, cache_key in cache_keys.items()
+               if cache_key not in cached]
+    if missing:
+        shard_keys = [_shard_keys(user_key, stat)
+                      for user_key, stat in missing]
+        shards = ndb.get_multi([key for keys in shard_keys for key in keys])
+        per_stat = NUM_SHARDS + 1
+        fresh = {}
+        for i, pair in enumerate(missing):
+            fresh[cache_keys[pair]] = sum(
+                shard.count for shard in
+                shards[i * per_stat:(i + 1) * per_stat] if shard)
+        # add() rather than set() so a concurrent incr() is not lost.
+        memcache.add_multi(fresh, time=CACHE_TTL)
+        cached.update(fresh)
+    return dict((user_key, dict((stat, cached[cache_keys[(user_key, stat)]])
+                                for stat in STATS))
+                for user_key in user_keys)
+
+
+def seed_legacy(users):
+    """Copies Users' old inline counts into their legacy shards. Safe to
+    run more than once, the legacy shards are overwritten not added to."""
+    ndb.put_multi([StatShard(key=_shard_key(user.key, stat, LEGACY_SHARD),
+                             count=getattr(user, stat) or 0)
+                   for user in users for stat in STATS])
+    memcache.delete_multi([_cache_key(user.key, stat)
+                           for user in users for stat in STATS])
+
+
+def move_shards(old_key, new_key):
+    """Re-homes a player's shards when the player is rekeyed. Returns the
+    new shards to put and the old shard keys to delete."""
+    old_keys = [key for stat in STATS for key in _shard_keys(old_key, stat)]
+    new_keys = [key for stat in STATS for key in _shard_keys(new_key, stat)]
+    shards = ndb.get_multi(old_keys)
+    moved = [StatShard(key=new_shard_key, count=shard.count)
+             for new_shard_key, shard in zip(new_keys, shards) if shard]
+    return moved, [shard.key for shard in shards if shard]
@@ -1,8 +1,39 @@
 import logging
-import endpoints
-from protorpc import messages
+import re
+import struct
+import time
+from protorpc import messages, protojson
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from models.user import User
+from board import get_rules
+from utils import key_from_urlsafe, get_by_urlsafe
+from instrumentation import timed
+from models import counter, leaderboard, stats
+from models.session import Session
+
+VERSION_KEY = 'game:version:{0}'
+# Spectator snapshots: a protojson GameForm per game, see get_snapshot().
+SNAPSHOT_KEY = 'game:snapshot:{0}'
+SNAPSHOT_LOCK_KEY = 'game:snapshot:lock:{0}'
+SNAPSHOT_LOCK_TTL = 5
+# How long spectators wait for another request's rebuild before doing it.
+SNAPSHOT_WAIT_SECONDS = 1
+SNAPSHOT_POLL_SECONDS = 0.05
+# Snapshots rebuilt by spectators expire, so one that raced a write made
+# outside a Session can't outlive it for long.
+SNAPSHOT_TTL = 60
+# Keys of missing games are remembered briefly so they can't stampede.
+MISSING_SNAPSHOT_TTL = 30
+LEGACY_MOVE = re.compile(r'player (\d) made a move on tile: (\d+)')
+# Game flags packed into ArchivedGame.flags, one bit each in this order.
+ARCHIVE_FLAGS = ('isPlayer1_X', 'isPlayer1_turn', 'cancelled', 'vs_computer')
+# Moves are packed into 15 bits for the square, so boards must stay well
+# under 181 x 181; this also bounds the cost of the line tables.
+MAX_BOARD_SIZE = 19
+
+
+def _pack_move(player, square):
+    return struct.pack('<H', square << 1 | (player - 1))
 
 
 class Game(ndb.Model):
@@ -10,12 +41,43 @@ class Game(ndb.Model):
     player1 = ndb.KeyProperty(required=True, kind='User')
     player2 = ndb.KeyProperty(required=False, kind='User')
     board = ndb.IntegerProperty(repeated=True)
+    board_size = ndb.IntegerProperty(indexed=False, default=3)
+    win_length = ndb.IntegerProperty(indexed=False, default=3)
+    # Single-player games: the computer is always player 2.
+    vs_computer = ndb.BooleanProperty(indexed=False, default=False)
     isPlayer1_X = ndb.BooleanProperty(required=True, default=True)
     isPlayer1_turn = ndb.BooleanProperty(required=True, default=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     winner = ndb.KeyProperty(required=False, kind='User')
     cancelled = ndb.BooleanProperty(required=False, default=False)
+    # Move text from before the packed move log; no longer written.
     history = ndb.StringProperty(repeated=True)
+    # Packed move log, one little-endian uint16 per move holding
+    # square << 1 | (player - 1). Rendered to text by history_lines().
+    moves = ndb.BlobProperty()
+    # Bumped on every put and mirrored to memcache, see get_version().
+    version = ndb.IntegerProperty(indexed=False, default=0)
+    # When the game was last written; the archive job queries on it.
+    modified = ndb.DateTimeProperty(auto_now=True)
+    # Stored the first time a form needs them so later forms don't
+    # derive them again; None on older games until then.
+    passkey = ndb.StringProperty(indexed=False)
+    player1_name = ndb.StringProperty(indexed=False)
+    player2_name = ndb.StringProperty(indexed=False)
+    # Request-scoped Session shared by this game's methods, see bind().
+    _session = None
+    # Set once version is bumped for a pending write, see _save().
+    _version_bumped = False
+    # Set on read-only games rebuilt from an ArchivedGame.
+    _archived = False
+    # GameForm fields to fill in, see with_fields(); None for all.
+    _form_fields = None
+    # (square, tile) of every cell changed by this request.
+    _changed = ()
+    # [player1, player2] bitboards, bit i set when the player holds square
+    # i. Built from board when first needed rather than stored: the
+    # datastore keeps integers as signed 64 bits, too few for 8 x 8 boards.
+    _masks = None
 
     @classmethod
     def new_game(
@@ -24,22 +86,205 @@ class Game(ndb.Model):
             board,
             isPlayer1_turn,
             isPlayer1_X,
-            player2=None):
-        """Creates and returns a new game"""
-        game = Game(player1=player1,
+            player2=None,
+            board_size=3,
+            win_length=3,
+            vs_computer=False,
+            key=None):
+        """Creates and returns a new game. Pass a key reserved with
+        allocate_ids_async() to defer the write: the game is then returned
+        unsaved, for the caller to commit along with its players, and
+        is written with its passkey."""
+        game = Game(key=key,
+                    player1=player1,
                     isPlayer1_X=isPlayer1_X,
                     board=board,
                     isPlayer1_turn=isPlayer1_turn,
                     player2=player2,
-                    game_over=False)
-        game.put()
+                    game_over=False,
+                    board_size=board_size,
+                    win_length=win_length,
+                    vs_computer=vs_computer)
+        if key is None:
+            game.put()
+        game._passkey()
         return game
 
+    @classmethod
+    def get_version(cls, urlsafe):
+        """Returns the current version of a game, read from memcache so
+        that polling for changes normally costs no datastore access.
+        Returns None if the game doesn't exist."""
+        version = memcache.get(VERSION_KEY.format(urlsafe))
+        if version is None:
+            key = key_from_urlsafe(urlsafe)
+            game = key.get()
+            if game is None and key.kind() == cls._get_kind():
+                game = cls.get_archived_async(key.id()).get_result()
+            if not isinstance(game, cls):
+                return None
+            version = game.version
+            memcache.add(VERSION_KEY.format(urlsafe), version)
+        return version
+
+    def _bump_version(self):
+        if not self._version_bumped:
+            self.version = (self.version or 0) + 1
+            self._version_bumped = True
+
+    @classmethod
+    @ndb.tasklet
+    def get_archived_async(cls, game_id):
+        """Returns a Future for the read-only Game rebuilt from the
+        archived copy of game_id, or None if there isn't one."""
+        archived = yield ArchivedGame.get_by_id_async(game_id)
+        raise ndb.Return(archived.to_game() if archived else None)
+
+    def _pre_put_hook(self):
+        if self._archived:
+            raise ValueError('Archived games are read-only')
+        # Games saved while the bitboards were stored drop them.
+        for name in ('player1_mask', 'player2_mask'):
+            if name in self._properties:
+                self._properties[name]._delete_value(self)
+                del self._properties[name]
+        self._bump_version()
+
+    def _post_put_hook(self, future):
+        self._version_bumped = False
+        if future.get_exception() is None and self._session is None:
+            # Games written through a Session are published by its flush.
+            # Here the snapshot would cost reads, so the next spectator
+            # rebuilds it instead.
+            urlsafe = self.key.urlsafe()
+            memcache.set(VERSION_KEY.format(urlsafe), self.version)
+            memcache.delete(SNAPSHOT_KEY.format(urlsafe))
+
+    def cache_keys(self):
+        """Returns the memcache keys mirroring this game."""
+        urlsafe = self.key.urlsafe()
+        return [VERSION_KEY.format(urlsafe), SNAPSHOT_KEY.format(urlsafe)]
+
+    def cache_entries(self):
+        """Returns the memcache entries mirroring this game, built by
+        Session.flush() just before the game is committed and written
+        once it is. Bumps the version the commit will write, if the
+        pending write hasn't already."""
+        self._bump_version()
+        urlsafe = self.key.urlsafe()
+        return {VERSION_KEY.format(urlsafe): self.version,
+                SNAPSHOT_KEY.format(urlsafe):
+                    protojson.encode_message(self.spectator_form())}
+
+    @classmethod
+    def get_snapshot(cls, urlsafe):
+        """Returns the spectator GameForm for a game from memcache, or None
+        if the game doesn't exist. When the snapshot is missing only one
+        request rebuilds it; the others wait for its result."""
+        cache_key = SNAPSHOT_KEY.format(urlsafe)
+        snapshot = memcache.get(cache_key)
+        if snapshot is None:
+            snapshot = cls._rebuild_snapshot(urlsafe)
+        if not snapshot:
+            return None
+        return protojson.decode_message(GameForm, snapshot)
+
+    @classmethod
+    def _rebuild_snapshot(cls, urlsafe):
+        cache_key = SNAPSHOT_KEY.format(urlsafe)
+        lock_key = SNAPSHOT_LOCK_KEY.format(urlsafe)
+        deadline = time.time() + SNAPSHOT_WAIT_SECONDS
+        locked = memcache.add(lock_key, 1, time=SNAPSHOT_LOCK_TTL)
+        while not locked and time.time() < deadline:
+            time.sleep(SNAPSHOT_POLL_SECONDS)
+            snapshot = memcache.get(cache_key)
+            if snapshot is not None:
+                return snapshot
+            locked = memcache.add(lock_key, 1, time=SNAPSHOT_LOCK_TTL)
+        try:
+            try:
+                game = get_by_urlsafe(urlsafe, cls)
+            except ValueError:
+                game = None
+            if game is None:
+                snapshot = ''
+                memcache.add(cache_key, snapshot, time=MISSING_SNAPSHOT_TTL)
+            else:
+                session = Session()
+                session.get_multi([key for key, name in (
+                    (game.player1, game.player1_name),
+                    (game.player2, game.player2_name)) if name is None])
+                snapshot = protojson.encode_message(
+                    game.bind(session).spectator_form())
+                # add() so a snapshot published by a write isn't replaced.
+                memcache.add(cache_key, snapshot, time=SNAPSHOT_TTL)
+        finally:
+            if locked:
+                memcache.delete(lock_key)
+        return snapshot
+
+    def bind(self, session):
+        """Shares a request-scoped Session with this game's methods so
+        that each User is resolved once and written back once."""
+        self._session = session
+        return self
+
+    def _get(self, key):
+        """Returns the entity for key through the bound Session."""
+        if self._session is None:
+            return key.get() if key is not None else None
+        return self._session.get(key)
+
+    def _get_multi(self, keys):
+        """Returns the entities for keys through the bound Session."""
+        if self._session is None:
+            return ndb.get_multi(keys)
+        return self._session.get_multi(keys)
+
+    def _save(self, entity):
+        """Writes a changed entity. When a Session is bound the write is
+        deferred: the entity is only marked dirty and the endpoint commits
+        it together with the others in a single put_multi. Saving the
+        game bumps its version straight away, so forms built before the
+        commit already carry the version being written."""
+        if entity is self:
+            self._bump_version()
+        if self._session is None:
+            entity.put()
+        else:
+            self._session.mark_dirty(entity)
+
+    def save(self):
+        """Writes the game, through the bound Session if there is one."""
+        self._save(self)
+        return self
+
+    def with_fields(self, fields):
+        """Starts a response: the forms built for this game are limited to
+        the named GameForm fields, the others being left empty and never
+        computed (None for full forms), and their cells list the squares
+        changed from here on."""
+        self._form_fields = fields
+        self._changed = ()
+        return self
+
+    @classmethod
+    def to_forms(cls, games, session):
+        """Returns GameForms for many games. Every User whose name the
+        games haven't stored is resolved with a single get_multi before
+        any form is built. Each form's message is the game's urlsafe
+        key."""
+        session.get_multi([key for game in games for key, name in (
+            (game.player1, game.player1_name),
+            (game.player2, game.player2_name)) if name is None])
+        return GameForms(items=[game.bind(session).to_form(game.key.urlsafe())
+                                for game in games])
+
     def base10toN(self, num, base):
         """Change ``num'' to given base
         Upto base 36 is supported."""
 
-        converted_string = "", ""
+        converted_string = ""
         currentnum = num
         if not 1 < base < 37:
             raise ValueError("base must be between 2 and 36")
@@ -57,131 +302,259 @@ class Game(ndb.Model):
         return '-'.join(passkey[i:i + 4] for i in
                         xrange(0, len(passkey), 4))
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def _passkey(self):
+        if self.passkey is None:
+            self.passkey = self.dashify(self.base10toN(self.key.id(), 36))
+        return self.passkey
+
+    def _player1_name(self):
+        if self.player1_name is None:
+            self.player1_name = self._get(self.player1).name
+        return self.player1_name
+
+    def _player2_name(self):
+        if self.player2_name is None and self.player2 is not None:
+            self.player2_name = self._get(self.player2).name
+        return self.player2_name
+
+    def _winner_name(self):
+        if self.winner is None:
+            return None
+        if self.winner == self.player1:
+            return self._player1_name()
+        return self._player2_name()
+
+    @timed('to_form')
+    def to_form(self, message, fields=None):
+        """Returns a GameForm representation of the Game, filling in only
+        fields, or the fields set by with_fields(), if given."""
+        values = {
+            'urlsafe_key': lambda: self.key.urlsafe(),
+            'board': lambda: self.board,
+            'game_over': lambda: self.game_over,
+            'message': lambda: message,
+            'player1_name': self._player1_name,
+            'player2_name': self._player2_name,
+            'isPlayer1_turn': lambda: self.isPlayer1_turn,
+            'isPlayer1_X': lambda: self.isPlayer1_X,
+            'passkey': self._passkey,
+            'winner': self._winner_name,
+            'cancelled': lambda: self.cancelled,
+            'history': lambda: [],
+            'version': lambda: self.version,
+            'cells': lambda: [CellForm(square=square, tile=tile)
+                              for square, tile in self._changed],
+        }
         form = GameForm()
-        form.urlsafe_key = self.key.urlsafe()
-        form.player1_name = self.player1.get().name
-        if self.player2 is not None:
-            form.player2_name = self.player2.get().name
-        form.board = self.board
-        form.game_over = self.game_over
-        form.isPlayer1_turn = self.isPlayer1_turn
-        form.isPlayer1_X = self.isPlayer1_X
-        form.message = message
-        game_key = self.key.id()
-        keyBase36 = self.base10toN(game_key, 36)
-        passkey = self.dashify(keyBase36)
-        form.passkey = passkey
-        form.cancelled = self.cancelled
-        if self.winner is not None:
-            form.winner = self.winner.get().name
-        if self.history is not None:
-            form.history = self.history
+        for name in fields or self._form_fields or GAME_FORM_FIELDS:
+            value = values[name]()
+            if value is not None:
+                setattr(form, name, value)
         return form
 
+    def spectator_form(self):
+        """Returns the game state shown to spectators: a GameForm without
+        the passkey and with a message describing the position."""
+        if self.cancelled:
+            message = 'Game Cancelled!'
+        elif self.game_over and self.winner is not None:
+            message = 'Game Over! The winner is: ' + self._winner_name()
+        elif self.game_over:
+            message = 'Draw Game!'
+        elif self.player2 is None:
+            message = 'Still waiting for second player to join.'
+        elif self.isPlayer1_turn:
+            message = self._player1_name() + ' to move.'
+        else:
+            message = self._player2_name() + ' to move.'
+        return self.to_form(message,
+                            GAME_FORM_FIELDS - set(['cells', 'passkey']))
+
     def end_game(self, winner=None, draw=False):
         """Ends the game - sets a winner if there is one,
         sets a draw game if there are no winners."""
         if winner:
-            victor = User.query(User.name == winner).get().key
-            self.winner = victor
+            self.winner = winner
             self.game_over = True
-            self.update_history()
-            self.put()
+            self._save(self)
         if draw:
             self.game_over = True
-            self.put()
+            self._save(self)
 
     def join_game(self, player2):
         """sets player 2 on a game."""
         self.player2 = player2
-        self.put()
+        self.player2_name = None
+        self._save(self)
+
+    def rules(self):
+        """Returns the shared BoardRules for this game's board."""
+        return get_rules(self.board_size, self.win_length)
 
-    def update_board(self, board):
-        """Updates a game's board."""
-        self.board = board
-        self.put()
+    def _bitboards(self):
+        if self._masks is None:
+            self._masks = list(self.rules().masks_from_board(self.board))
+        return self._masks
 
-    def update_history(self, player=None, board=None):
-        """Updates a game's move history."""
+    @property
+    def player1_mask(self):
+        return self._bitboards()[0]
+
+    @property
+    def player2_mask(self):
+        return self._bitboards()[1]
+
+    def update_board(self, move, square):
+        """Places a player's move on the board and its bitboard."""
+        masks = self._bitboards()
+        self.board[square] = move
+        self._changed = self._changed + ((square, move),)
+        masks[move - 1] |= 1 << square
+        self._save(self)
+
+    def update_history(self, player, board):
+        """Appends a move to the game's packed move log."""
         logging.info(player)
         logging.info(board)
-        if player is not None and board is not None:
-            history_string = "player {0} made a move on tile: {1}".format(
-                player, board)
-            self.history.append(history_string)
-        if self.winner is not None:
-            self.history.append(
-                "{0} won the game!".format(
-                    self.winner.get().name))
-        self.put()
-
-    def is_victory_achieved(self):
-        """Check if a move triggers a win for both players.
-        If no victory, then check for a draw. If no draw,
-        make it the next player's turn."""
-        # Possible game victories.
-        top_row = [self.board[0], self.board[1], self.board[2]]
-        middle_row = [self.board[3], self.board[4], self.board[5]]
-        bottom_row = [self.board[6], self.board[7], self.board[8]]
-        left_column = [self.board[0], self.board[3], self.board[6]]
-        middle_column = [self.board[1], self.board[4], self.board[7]]
-        right_column = [self.board[2], self.board[5], self.board[8]]
-        left_diagonal = [self.board[0], self.board[4], self.board[8]]
-        right_diagonal = [self.board[2], self.board[4], self.board[6]]
-        victory_conditions = [top_row, middle_row, bottom_row,
-                              left_column, middle_column, right_column,
-                              left_diagonal, right_diagonal]
-        # Loop through possible victories.
-        for victory in victory_conditions:
-            logging.info(str(victory) +
-                         str(victory.count(victory[0]) == len(victory)))
-            victory_achieved = victory.count(victory[0]) == len(victory)
-            # Check if player one won and update Game and User accordingly.
-            if victory_achieved and victory[0] == 1:
-                winner = self.player1.get().name
-                self.end_game(winner)
-                self.player1.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player2.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player1.get().wins += 1
-                self.player2.get().losses += 1
-                self.player1.get().put()
-                self.player2.get().put()
-                return self.to_form("Game Over! The winner is: " + winner)
-            # Check if player two won and update Game and User accordingly.
-            if victory_achieved and victory[0] == 2:
-                winner = self.player2.get().name
-                self.end_game(winner)
-                self.player1.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player2.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player2.get().wins += 1
-                self.player1.get().losses += 1
-                self.player1.get().put()
-                self.player2.get().put()
-                return self.to_form("Game Over! The winner is " + winner)
-            # Check if game is a draw. Update Game and User accordingly.
-            if all(v != 0 for v in self.board):
-                self.end_game(None, True)
-                self.player1.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player2.get().gameKeysPlaying.remove(self.key.urlsafe())
-                self.player2.get().draws += 1
-                self.player1.get().draws += 1
-                self.player1.get().put()
-                self.player2.get().put()
-                return self.to_form("Draw Game!")
+        self.moves = (self.moves or '') + _pack_move(player, board)
+        self._save(self)
+
+    def move_log(self):
+        """Returns the moves made so far as (player, square) pairs."""
+        log = [(int(player), int(square)) for player, square in
+               (LEGACY_MOVE.match(line).groups() for line in self.history
+                if LEGACY_MOVE.match(line))]
+        packed = self.moves or ''
+        log.extend(((move & 1) + 1, move >> 1) for move in
+                   struct.unpack('<{0}H'.format(len(packed) // 2), packed))
+        return log
+
+    def export_record(self):
+        """Returns a plain dict describing a finished game, one line of
+        the game export."""
+        if self.cancelled:
+            result = 'cancelled'
+        elif self.winner is None:
+            result = 'draw'
+        elif self.winner == self.player1:
+            result = 'player1'
+        else:
+            result = 'player2'
+        log = self.move_log()
+        return {'key': self.key.urlsafe(),
+                'player1': str(self.player1.id()),
+                'player2': str(self.player2.id()) if self.player2 else None,
+                'board_size': self.board_size,
+                'win_length': self.win_length,
+                'vs_computer': self.vs_computer,
+                'result': result,
+                'first': log[0][0] if log else None,
+                'moves': [square for _, square in log]}
+
+    def history_lines(self, since=0):
+        """Renders the move history as text, starting at line since."""
+        packed = self.moves or ''
+        lines = list(self.history)
+        lines.extend("player {0} made a move on tile: {1}".format(
+            (move & 1) + 1, move >> 1)
+            for move in struct.unpack('<{0}H'.format(len(packed) // 2),
+                                      packed))
+        # Games finished before the move log already have this line.
+        if self.winner is not None and packed:
+            lines.append("{0} won the game!".format(
+                self._get(self.winner).name))
+        return lines[since:]
+
+    @timed('is_victory_achieved')
+    def is_victory_achieved(self, square):
+        """Check if the move just made on square triggers a win for the
+        player who made it. If no victory, then check for a draw."""
+        rules = self.rules()
+        # Check if player one won and update Game and User accordingly.
+        if self.board[square] == 1 and \
+                rules.is_win(self.player1_mask, square):
+            winner = self._get(self.player1)
+            self.end_game(winner.key)
+            self._record_result(winner, self._get(self.player2))
+            return self.to_form("Game Over! The winner is: " + winner.name)
+        # Check if player two won and update Game and User accordingly.
+        if self.board[square] == 2 and \
+                rules.is_win(self.player2_mask, square):
+            winner = self._get(self.player2)
+            self.end_game(winner.key)
+            self._record_result(winner, self._get(self.player1))
+            return self.to_form("Game Over! The winner is " + winner.name)
+        # Check if game is a draw. Update Game and User accordingly.
+        if rules.is_full(self.player1_mask, self.player2_mask):
+            self.end_game(None, True)
+            self._record_result(self._get(self.player1),
+                                self._get(self.player2),
+                                draw=True)
+            return self.to_form("Draw Game!")
         return self.to_form("Move Made! Next player's move!")
 
+    def _record_result(self, winner, loser, draw=False):
+        """Removes the finished game from both players' active games and
+        updates their win, loss and draw records."""
+        urlsafe = self.key.urlsafe()
+        players = [player for player in (winner, loser)
+                   if not player.is_computer]
+        old_scores = [player.score for player in players]
+        if draw:
+            counter.increment_multi([(winner.key, 'draws'),
+                                     (loser.key, 'draws')])
+        else:
+            counter.increment_multi([(winner.key, 'wins'),
+                                     (loser.key, 'losses')])
+        totals = counter.get_totals([winner.key, loser.key])
+        for player in players:
+            player.gameKeysPlaying.remove(urlsafe)
+            player.update_score(totals[player.key])
+            self._save(player)
+        leaderboard.record_scores(zip(old_scores,
+                                      [player.score for player in players]))
+        self.record_stats(winner, loser, stats.DRAW if draw else stats.WIN)
+
+    def record_stats(self, first, second, result):
+        """Updates the head-to-head record, streaks and recent results of
+        the Users first and second, where result is first's. They are
+        written along with the game."""
+        keys = stats.keys_for(first.key, second.key)
+        for entity in stats.apply(self._get_multi(keys), first, second,
+                                  result, self.key.urlsafe()):
+            self._save(entity)
+
+    def is_computer_turn(self):
+        """Checks whether the computer should move next."""
+        return self.vs_computer and not self.game_over and \
+            not self.isPlayer1_turn
+
+    def play_computer_move(self):
+        """Plays the computer's reply, chosen by the solver, and returns
+        the resulting game state. The reply is instant on 3 x 3 boards and
+        searched for at most about solver.SEARCH_BUDGET_MS on larger ones."""
+        # Imported here so handlers that never play the computer, like the
+        # cron and task handlers, don't load the solver.
+        import solver
+        square = solver.best_move(self.board_size, self.win_length,
+                                  self.player2_mask, self.player1_mask)
+        self.update_board(2, square)
+        self.update_history(2, square)
+        self.pass_turn()
+        return self.is_victory_achieved(square)
+
     def pass_turn(self):
         """Make it the next player's turn."""
         if self.isPlayer1_turn:
             self.isPlayer1_turn = False
         else:
             self.isPlayer1_turn = True
-        self.put()
+        self._save(self)
 
     def is_move_legal(self, current_user, request):
         """validates that a move is legal and returns a move if it is."""
+        # Like the solver, only loaded by the handlers that need it.
+        import endpoints
         player1_number = 1
         player2_number = 2
         move = 0
@@ -189,17 +562,15 @@ class Game(ndb.Model):
             raise endpoints.ConflictException("Please wait for a second " +
                                               "player to join before " +
                                               "making a move.")
-        if current_user.name != self.player1.get(
-        ).name and current_user.name != self.player2.get().name:
+        if current_user.key not in (self.player1, self.player2):
             raise endpoints.UnauthorizedException(
                 "You are not a member of this game.")
         if self.game_over:
             raise endpoints.ConflictException('Game already over!')
-        if self.isPlayer1_turn and current_user.name == \
-                self.player1.get().name:
+        if self.isPlayer1_turn and current_user.key == self.player1:
             move = player1_number
-        elif self.isPlayer1_turn is False and current_user.name == \
-                self.player2.get().name:
+        elif self.isPlayer1_turn is False and \
+                current_user.key == self.player2:
             move = player2_number
         else:
             raise endpoints.ConflictException(
@@ -211,26 +582,115 @@ class Game(ndb.Model):
         return move
 
 
+class ArchivedGame(ndb.Model):
+    """Compact copy of a finished Game, keyed by the same id and indexed
+    only by its players, so that rekeyed users can be repointed. Written
+    by the /tasks/archive_games job, which then deletes the Game;
+    Game.get_archived_async() reads it back."""
+    player1 = ndb.KeyProperty(kind='User')
+    player2 = ndb.KeyProperty(kind='User')
+    winner = ndb.KeyProperty(kind='User', indexed=False)
+    # One byte per square: 0 when empty, else the player holding it.
+    board = ndb.BlobProperty()
+    # Packed like Game.moves, with any legacy history text folded in.
+    moves = ndb.BlobProperty()
+    # One bit per entry of ARCHIVE_FLAGS.
+    flags = ndb.IntegerProperty(indexed=False, default=0)
+    win_length = ndb.IntegerProperty(indexed=False, default=3)
+    version = ndb.IntegerProperty(indexed=False, default=0)
+    modified = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns the archive entity for a finished game."""
+        return cls(id=game.key.id(),
+                   player1=game.player1,
+                   player2=game.player2,
+                   winner=game.winner,
+                   board=str(bytearray(game.board)),
+                   moves=''.join(_pack_move(player, square)
+                                 for player, square in game.move_log()),
+                   flags=sum(1 << bit for bit, name in
+                             enumerate(ARCHIVE_FLAGS) if getattr(game, name)),
+                   win_length=game.win_length,
+                   version=game.version,
+                   modified=game.modified)
+
+    def to_game(self):
+        """Returns the archived game as a read-only Game."""
+        board = list(bytearray(self.board or ''))
+        game = Game(key=ndb.Key(Game, self.key.id()),
+                    player1=self.player1,
+                    player2=self.player2,
+                    winner=self.winner,
+                    board=board,
+                    board_size=int(round(len(board) ** 0.5)),
+                    win_length=self.win_length,
+                    moves=self.moves,
+                    game_over=True,
+                    version=self.version,
+                    modified=self.modified,
+                    **dict((name, bool(self.flags >> bit & 1))
+                           for bit, name in enumerate(ARCHIVE_FLAGS)))
+        game._archived = True
+        return game
+
+
+class CellForm(messages.Message):
+    """A board square and the tile now on it"""
+    square = messages.IntegerField(1, required=True)
+    tile = messages.IntegerField(2, required=True)
+
+
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
-    urlsafe_key = messages.StringField(1, required=True)
+    """GameForm for outbound game state information. Fields left out of
+    a request's field mask are empty."""
+    urlsafe_key = messages.StringField(1)
     board = messages.IntegerField(2, repeated=True)
-    game_over = messages.BooleanField(3, required=True)
-    message = messages.StringField(4, required=True)
-    player1_name = messages.StringField(5, required=True)
-    player2_name = messages.StringField(6, required=False)
-    isPlayer1_turn = messages.BooleanField(7, required=True)
-    isPlayer1_X = messages.BooleanField(8, required=True)
-    passkey = messages.StringField(9, required=True)
-    winner = messages.StringField(10, required=False)
-    cancelled = messages.BooleanField(11, required=True)
+    game_over = messages.BooleanField(3)
+    message = messages.StringField(4)
+    player1_name = messages.StringField(5)
+    player2_name = messages.StringField(6)
+    isPlayer1_turn = messages.BooleanField(7)
+    isPlayer1_X = messages.BooleanField(8)
+    passkey = messages.StringField(9)
+    winner = messages.StringField(10)
+    cancelled = messages.BooleanField(11)
     history = messages.StringField(12, repeated=True)
+    version = messages.IntegerField(13)
+    # Squares changed by this request: the move, and any computer reply.
+    cells = messages.MessageField(CellForm, 14, repeated=True)
+
+
+GAME_FORM_FIELDS = frozenset(field.name for field in GameForm.all_fields())
+# What a client already holding the game needs after a move.
+DELTA_FIELDS = frozenset(['cells', 'isPlayer1_turn', 'game_over', 'winner',
+                          'version'])
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     player2_name = messages.StringField(1, required=False)
     isPlayer1_X = messages.BooleanField(2, required=True)
+    board_size = messages.IntegerField(3, default=3)
+    win_length = messages.IntegerField(4, default=3)
+    vs_computer = messages.BooleanField(5, default=False)
+    fields = messages.StringField(6, repeated=True)
+    delta = messages.BooleanField(7, default=False)
+
+
+class PairingForm(messages.Message):
+    """One game of a bulk request"""
+    player1_name = messages.StringField(1, required=True)
+    player2_name = messages.StringField(2, required=True)
+    isPlayer1_X = messages.BooleanField(3, default=True)
+    board_size = messages.IntegerField(4, default=3)
+    win_length = messages.IntegerField(5, default=3)
+
+
+class BulkGameForm(messages.Message):
+    """Used to create many games at once, e.g. a tournament round"""
+    pairings = messages.MessageField(PairingForm, 1, repeated=True)
 
 
 class JoinGameForm(messages.Message):
@@ -248,6 +708,40 @@ class GameForms(messages.Message):
     items = messages.MessageField(GameForm, 1, repeated=True)
 
 
+class MoveForm(messages.Message):
+    """One move in a batch of moves"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    board = messages.IntegerField(2, required=True)
+
+
+class BatchMoveForm(messages.Message):
+    """Used to make many moves across games in one request"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+    fields = messages.StringField(2, repeated=True)
+    delta = messages.BooleanField(3, default=False)
+
+
+class MoveResultForm(messages.Message):
+    """The outcome of one move in a batch: the new game state, or the
+    reason the move was refused"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    board = messages.IntegerField(2, required=True)
+    game = messages.MessageField(GameForm, 3)
+    error = messages.StringField(4)
+
+
+class MoveResultForms(messages.Message):
+    """Returns the outcome of each move in a batch"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
+class GameVersionForm(messages.Message):
+    """Reports whether a game changed since the version a client holds."""
+    version = messages.IntegerField(1, required=True)
+    modified = messages.BooleanField(2, required=True)
+
+
 class GameHistoryForm(messages.Message):
     """Used to return a game's move history."""
     moves = messages.StringField(1, repeated=True)
+    next_since = messages.IntegerField(2)
@@ -0,0 +1,108 @@
+"""leaderboard.py - Materialized ranking structures for the leaderboard.
+
+Users are ordered by their indexed score, so leaderboard pages are a
+cursor query over that index. A player's rank is answered from a
+histogram of scores kept as a Fenwick (binary indexed) tree: counting the
+players that score higher takes O(log n) steps whatever the number of
+users. The tree is split over several shard entities so that game ends
+don't all contend on one entity."""
+
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 10
+# Scores at or above the cap share the top cell of the tree, which keeps
+# each shard well under the entity size limit. Players that high are
+# ranked exactly by the ordered query instead.
+MAX_SCORE = 2 ** 14
+TOP_PAGE_KEY = 'leaderboard:top:{0}'
+TOP_PAGE_TTL = 60
+
+
+class ScoreShard(ndb.Model):
+    """One shard of the score histogram, stored as a Fenwick tree where
+    cell i counts players whose score is i - 1."""
+    tree = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+def _cell(score):
+    """Returns the 1-indexed tree cell for a score."""
+    return min(max(score, 0), MAX_SCORE - 1) + 1
+
+
+def _add(tree, score, delta):
+    """Adds delta to the count of players with score."""
+    size = len(tree) - 1
+    cell = _cell(score)
+    while size < cell:
+        # Doubling a Fenwick tree only adds a new root holding the total.
+        tree.extend([0] * (size - 1 if size else 0))
+        tree.append(_prefix(tree, size) if size else 0)
+        size = max(size * 2, 1)
+    while cell <= size:
+        tree[cell] += delta
+        cell += cell & -cell
+
+
+def _prefix(tree, cell):
+    """Returns the number of players in cells 1..cell."""
+    total = 0
+    cell = min(cell, len(tree) - 1)
+    while cell > 0:
+        total += tree[cell]
+        cell -= cell & -cell
+    return total
+
+
+@ndb.transactional
+def _update_shard(shard_id, changes):
+    shard = ScoreShard.get_by_id(shard_id) or ScoreShard(id=shard_id,
+                                                         tree=[0])
+    for old_score, new_score in changes:
+        if old_score is not None:
+            _add(shard.tree, old_score, -1)
+        _add(shard.tree, new_score, 1)
+    shard.put()
+
+
+def record_scores(changes):
+    """Moves players between scores in the histogram.
+    Args:
+        changes: (old_score, new_score) pairs; old_score is None for a
+        player who was not ranked before."""
+    if changes:
+        _update_shard(random.randint(0, NUM_SHARDS - 1), list(changes))
+
+
+def rank_of(score):
+    """Returns the 1-based rank of a player with score."""
+    shards = ndb.get_multi([ndb.Key(ScoreShard, shard_id)
+                            for shard_id in range(NUM_SHARDS)])
+    higher = 0
+    for shard in shards:
+        if shard:
+            higher += _prefix(shard.tree, len(shard.tree) - 1) - \
+                _prefix(shard.tree, _cell(score))
+    return higher + 1
+
+
+def rebuild(scores):
+    """Replaces the histogram with one built from an iterable of scores."""
+    tree = [0]
+    for score in scores:
+        _add(tree, score, 1)
+    shards = [ScoreShard(id=shard_id, tree=[0])
+              for shard_id in range(NUM_SHARDS)]
+    shards[0].tree = tree
+    ndb.put_multi(shards)
+
+
+def get_top_page(limit):
+    """Returns the cached first leaderboard page for limit, or None."""
+    return memcache.get(TOP_PAGE_KEY.format(limit))
+
+
+def set_top_page(limit, page):
+    """Caches the first leaderboard page for a short while."""
+    memcache.set(TOP_PAGE_KEY.format(limit), page, time=TOP_PAGE_TTL)
@@ -0,0 +1,96 @@
+"""matchmaking.py - Queue of open games waiting for a second player.
+
+Open games are offered through MatchTicket entities spread over several
+shards. A player looking for a match reads the oldest tickets of every
+shard and claims one in a transaction over the ticket and its game, so
+concurrent joiners contend on different tickets and a game can never be
+joined twice."""
+
+import random
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import instrumentation
+
+NUM_SHARDS = 16
+# Tickets read per shard; joiners pick among them at random.
+CANDIDATES = 5
+
+
+class MatchTicket(ndb.Model):
+    """An open game waiting for an opponent, keyed by its player's id so
+    a player has at most one game in the queue."""
+    game = ndb.KeyProperty(required=True, kind='Game')
+    shard = ndb.IntegerProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+def get_ticket(user_key):
+    """Returns the player's waiting ticket, or None."""
+    return MatchTicket.get_by_id(str(user_key.id()))
+
+
+def enqueue(game):
+    """Offers an open game to other players looking for a match."""
+    ticket = MatchTicket(id=str(game.player1.id()), game=game.key,
+                         shard=random.randint(0, NUM_SHARDS - 1))
+    ticket.put()
+    return ticket
+
+
+def _seat(game, user_key):
+    """Makes the player player 2 of game if it is still open, inside the
+    caller's transaction over the game. Returns the game, or None."""
+    if game is None or game.player2 is not None or game.game_over:
+        return None
+    game.join_game(user_key)
+    return game
+
+
+@ndb.transactional(xg=True)
+def _claim(ticket_key, user_key):
+    ticket = ticket_key.get()
+    if ticket is None:
+        return None
+    game = ticket.game.get()
+    if game is not None and game.player1 == user_key:
+        return None
+    ticket.key.delete()
+    # None if joined by passcode or cancelled since it was queued.
+    return _seat(game, user_key)
+
+
+@ndb.transactional(xg=True)
+def join(game_key, user_key):
+    """Joins the player to a game by its passcode, in a transaction like
+    claim()'s so that a game can never be joined twice, and takes the game
+    out of the queue. Returns the game, or None if it is no longer open."""
+    game = game_key.get()
+    if game is not None and game.player2 is None:
+        ticket = get_ticket(game.player1)
+        if ticket and ticket.game == game_key:
+            ticket.key.delete()
+    return _seat(game, user_key)
+
+
+def claim(user_key):
+    """Joins the player to one of the oldest open games. Every shard is
+    read at once, so an open game is found wherever it is queued. Returns
+    the game, or None when no open game could be claimed."""
+    futures = [MatchTicket.query(MatchTicket.shard == shard).order(
+        MatchTicket.created).fetch_async(CANDIDATES, keys_only=True)
+        for shard in range(NUM_SHARDS)]
+    random.shuffle(futures)
+    for future in futures:
+        ticket_keys = future.get_result()
+        random.shuffle(ticket_keys)
+        for ticket_key in ticket_keys:
+            try:
+                game = _claim(ticket_key, user_key)
+            except datastore_errors.TransactionFailedError:
+                # Another joiner is claiming it; try the next ticket.
+                instrumentation.count('match_contention')
+                continue
+            if game is not None:
+                return game
+    return None
@@ -0,0 +1,98 @@
+"""session.py - Request-scoped identity map and unit of work for ndb
+entities."""
+
+import logging
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+class Session(object):
+    """Tracks the entities loaded during a single request so that each
+    one is fetched at most once and shared by every method that needs it.
+    Entities marked dirty are written back together by flush(), so a
+    request costs one put_multi however many times it changes them.
+    Entities with cache_entries() and cache_keys() methods then have those
+    entries written to memcache, again in one batch; a cache failure is logged
+    and never fails the request."""
+
+    def __init__(self):
+        self._entities = {}
+        self._dirty = []
+        self._dirty_ids = set()
+        self.gets = 0
+        self.gets_saved = 0
+        self.puts = 0
+
+    def get(self, key):
+        """Returns the entity for key, fetching it at most once."""
+        if key is None:
+            return None
+        if key in self._entities:
+            self.gets_saved += 1
+            return self._entities[key]
+        entity = key.get()
+        self.gets += 1
+        self._entities[key] = entity
+        return entity
+
+    def get_multi(self, keys):
+        """Returns the entities for keys, fetching every one not already
+        in the identity map with a single get_multi."""
+        wanted = [key for key in keys if key is not None]
+        missing = list(set(key for key in wanted
+                           if key not in self._entities))
+        if missing:
+            self._entities.update(zip(missing, ndb.get_multi(missing)))
+            self.gets += len(missing)
+        self.gets_saved += len(wanted) - len(missing)
+        return [self._entities.get(key) for key in keys]
+
+    def add(self, entity):
+        """Adds an entity loaded some other way (e.g. by a query) to the
+        identity map and returns the instance the session will share."""
+        if entity is None or entity.key is None:
+            return entity
+        return self._entities.setdefault(entity.key, entity)
+
+    def mark_dirty(self, entity):
+        """Schedules an entity to be written when the session is flushed."""
+        self.add(entity)
+        if id(entity) not in self._dirty_ids:
+            self._dirty_ids.add(id(entity))
+            self._dirty.append(entity)
+
+    def flush(self):
+        """Writes every dirty entity and returns how many were written."""
+        dirty = self._dirty
+        self._dirty = []
+        self._dirty_ids = set()
+        if dirty:
+            # Cache entries are built before the commit, so any reads they
+            # need can't fail a request whose writes have been made.
+            # Entries that can't be built are dropped from memcache instead.
+            entries, stale = {}, []
+            for entity in dirty:
+                if hasattr(entity, 'cache_entries'):
+                    try:
+                        entries.update(entity.cache_entries())
+                    except Exception:
+                        logging.exception('Building cache entries for %s '
+                                          'failed', entity.key)
+                        stale.extend(entity.cache_keys())
+            ndb.put_multi(dirty)
+            self.puts += len(dirty)
+            try:
+                if entries:
+                    memcache.set_multi(entries)
+                if stale:
+                    memcache.delete_multi(stale)
+            except Exception:
+                logging.exception('Updating %d cache entries failed',
+                                  len(entries) + len(stale))
+        return len(dirty)
+
+    def report(self, name):
+        """Logs the datastore gets and puts made through the session."""
+        logging.info('%s: %d datastore gets, %d saved by the session, '
+                     '%d entities put', name, self.gets, self.gets_saved,
+                     self.puts)
@@ -0,0 +1,168 @@
+"""stats.py - Head-to-head records and recent form for players.
+
+Both are denormalized and kept up to date as games end, so every read is
+a single get by key and never a scan over games. A finished or cancelled
+game loads the two players' PlayerStats and their HeadToHead entity with
+one get_multi and writes them back through the game's Session, in the
+same put_multi that commits the game."""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+WIN, LOSS, DRAW, CANCELLED = 'win', 'loss', 'draw', 'cancelled'
+OPPOSITE = {WIN: LOSS, LOSS: WIN, DRAW: DRAW, CANCELLED: CANCELLED}
+# Results kept in each player's ring of recent games.
+RECENT_LIMIT = 20
+
+
+class PlayerStats(ndb.Model):
+    """A player's streaks and most recent results, keyed by User id."""
+    # Wins in a row when positive, losses in a row when negative.
+    streak = ndb.IntegerProperty(indexed=False, default=0)
+    best_streak = ndb.IntegerProperty(indexed=False, default=0)
+    # [result, opponent name, urlsafe game key], newest first.
+    recent = ndb.JsonProperty(default=[])
+
+    def add_result(self, result, opponent, urlsafe):
+        """Records a result against the named opponent."""
+        if result == WIN:
+            self.streak = max(self.streak, 0) + 1
+            self.best_streak = max(self.best_streak, self.streak)
+        elif result == LOSS:
+            self.streak = min(self.streak, 0) - 1
+        elif result == DRAW:
+            self.streak = 0
+        self.recent = [[result, opponent, urlsafe]] + \
+            self.recent[:RECENT_LIMIT - 1]
+
+    def to_form(self, player):
+        return PlayerStatsForm(
+            player=player,
+            streak=self.streak,
+            best_streak=self.best_streak,
+            recent=[RecentResultForm(result=result, opponent=opponent,
+                                     urlsafe_game_key=urlsafe)
+                    for result, opponent, urlsafe in self.recent])
+
+
+class HeadToHead(ndb.Model):
+    """The record between two players, keyed by their sorted User ids
+    and counted from the side of the first."""
+    wins = ndb.IntegerProperty(indexed=False, default=0)
+    losses = ndb.IntegerProperty(indexed=False, default=0)
+    draws = ndb.IntegerProperty(indexed=False, default=0)
+    cancelled = ndb.IntegerProperty(indexed=False, default=0)
+    # Both players' User ids, so a rekeyed player's records can be found.
+    players = ndb.StringProperty(repeated=True)
+
+    def add_result(self, user_key, result):
+        """Records a result from the side of user_key."""
+        if not _is_first(user_key, self.key):
+            result = OPPOSITE[result]
+        counts = {WIN: 'wins', LOSS: 'losses', DRAW: 'draws',
+                  CANCELLED: 'cancelled'}[result]
+        setattr(self, counts, getattr(self, counts) + 1)
+
+    def to_form(self, user_key, player, opponent):
+        """Returns the record from the side of user_key."""
+        wins, losses = self.wins, self.losses
+        if not _is_first(user_key, self.key):
+            wins, losses = losses, wins
+        return HeadToHeadForm(player=player, opponent=opponent, wins=wins,
+                              losses=losses, draws=self.draws,
+                              cancelled=self.cancelled)
+
+
+def _pair_ids(first, second):
+    return sorted([str(first.id()), str(second.id())])
+
+
+def _is_first(user_key, pair_key):
+    return pair_key.id().split('|', 1)[0] == str(user_key.id())
+
+
+def player_key(user_key):
+    return ndb.Key(PlayerStats, str(user_key.id()))
+
+
+def pair_key(first, second):
+    return ndb.Key(HeadToHead, '|'.join(_pair_ids(first, second)))
+
+
+def keys_for(first, second):
+    """Returns the keys of the stats a game between two Users changes."""
+    return [player_key(first), player_key(second), pair_key(first, second)]
+
+
+def apply(entities, first, second, result, urlsafe):
+    """Records a game between Users first and second, where result is
+    first's, into the entities loaded for keys_for(), creating any that
+    are missing. Returns the entities to write. The computer has no
+    PlayerStats; its head-to-head records are kept."""
+    first_stats, second_stats, pair = entities
+    changed = []
+    for player, opponent, stats, outcome in (
+            (first, second, first_stats, result),
+            (second, first, second_stats, OPPOSITE[result])):
+        if player.is_computer:
+            continue
+        stats = stats or PlayerStats(key=player_key(player.key))
+        stats.add_result(outcome, opponent.name, urlsafe)
+        changed.append(stats)
+    pair = pair or HeadToHead(key=pair_key(first.key, second.key),
+                              players=_pair_ids(first.key, second.key))
+    pair.add_result(first.key, result)
+    changed.append(pair)
+    return changed
+
+
+def move_stats(old_key, new_key):
+    """Re-homes a player's stats and head-to-head records when the player
+    is rekeyed. Returns the new entities to put and the old keys to
+    delete."""
+    old_id, new_id = str(old_key.id()), str(new_key.id())
+    moved, old_keys = [], []
+    stats = player_key(old_key).get()
+    if stats:
+        moved.append(PlayerStats(key=player_key(new_key), **stats.to_dict()))
+        old_keys.append(stats.key)
+    for pair in HeadToHead.query(HeadToHead.players == old_id):
+        other = [player for player in pair.players if player != old_id][0]
+        # Counted from the player's side, then from whichever id sorts
+        # first once the player is renamed.
+        wins, losses = pair.wins, pair.losses
+        if not _is_first(old_key, pair.key):
+            wins, losses = losses, wins
+        ids = sorted([new_id, other])
+        if ids[0] != new_id:
+            wins, losses = losses, wins
+        moved.append(HeadToHead(id='|'.join(ids), players=ids, wins=wins,
+                                losses=losses, draws=pair.draws,
+                                cancelled=pair.cancelled))
+        old_keys.append(pair.key)
+    return moved, old_keys
+
+
+class RecentResultForm(messages.Message):
+    """One of a player's recent games"""
+    result = messages.StringField(1, required=True)
+    opponent = messages.StringField(2)
+    urlsafe_game_key = messages.StringField(3)
+
+
+class PlayerStatsForm(messages.Message):
+    """A player's streaks and recent results"""
+    player = messages.StringField(1, required=True)
+    streak = messages.IntegerField(2)
+    best_streak = messages.IntegerField(3)
+    recent = messages.MessageField(RecentResultForm, 4, repeated=True)
+
+
+class HeadToHeadForm(messages.Message):
+    """A player's record against one opponent"""
+    player = messages.StringField(1, required=True)
+    opponent = messages.StringField(2, required=True)
+    wins = messages.IntegerField(3)
+    losses = messages.IntegerField(4)
+    draws = messages.IntegerField(5)
+    cancelled = messages.IntegerField(6)
@@ -1,5 +1,9 @@
 from protorpc import messages
 from google.appengine.ext import ndb
+from models import counter
+
+# Key id of the User that plays single-player games.
+COMPUTER_ID = '__computer__'
 
 
 class User(ndb.Model):
@@ -7,18 +11,77 @@ class User(ndb.Model):
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     gameKeysPlaying = ndb.StringProperty(repeated=True)
+    # Counts from before sharded counters, see counter.seed_legacy().
+    # Current totals are read with counter.get_totals().
     wins = ndb.IntegerProperty(default=0)
     losses = ndb.IntegerProperty(default=0)
     draws = ndb.IntegerProperty(default=0)
+    # Leaderboard ranking: two points for a win, one for a draw.
+    score = ndb.IntegerProperty(default=0)
+    # Indexed so the reminder cron can filter on it with one equality.
+    needs_reminder = ndb.ComputedProperty(
+        lambda self: bool(self.email and self.gameKeysPlaying))
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with name, or None. Users are keyed by name so
+        this is a strongly consistent get that ndb serves from its caches
+        when it can."""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Asynchronous get_by_name(). Returns a Future."""
+        user = yield cls.get_by_id_async(name)
+        if user is None:
+            # Users created before keying by name have datastore allocated
+            # ids until /tasks/migrate_user_keys rekeys them.
+            user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def computer(cls):
+        """Returns the User that plays single-player games. Its games are
+        not listed in gameKeysPlaying and it has no leaderboard score."""
+        return cls.computer_async().get_result()
+
+    @classmethod
+    def computer_async(cls):
+        """Asynchronous computer(). Returns a Future."""
+        return cls.get_or_insert_async(COMPUTER_ID, name='Computer')
+
+    @property
+    def is_computer(self):
+        return self.key is not None and self.key.id() == COMPUTER_ID
+
+    @classmethod
+    @ndb.transactional
+    def create(cls, name, email):
+        """Creates a User keyed by name. Returns None if another request
+        created it first."""
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        user.put()
+        return user
+
+    def update_score(self, totals):
+        """Recomputes the ranking score from the player's counter totals."""
+        self.score = 2 * totals['wins'] + totals['draws']
 
-    def to_form(self):
+    def to_form(self, rank=None, totals=None):
         """Returns form representation
         of User Entity."""
+        if totals is None:
+            totals = counter.get_totals([self.key])[self.key]
         form = LeaderboardForm()
         form.player = self.name
-        form.wins = self.wins
-        form.losses = self.losses
-        form.draws = self.draws
+        form.wins = totals['wins']
+        form.losses = totals['losses']
+        form.draws = totals['draws']
+        form.score = self.score
+        form.rank = rank
         return form
 
 
@@ -28,11 +91,14 @@ class LeaderboardForm(messages.Message):
     wins = messages.IntegerField(2)
     losses = messages.IntegerField(3)
     draws = messages.IntegerField(4)
+    score = messages.IntegerField(5)
+    rank = messages.IntegerField(6)
 
 
 class LeaderboardForms(messages.Message):
     """Multiple players' game records"""
     items = messages.MessageField(LeaderboardForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,116 @@
+"""ratelimit.py - Per-user admission control for the write endpoints.
+
+Each (endpoint, user) pair has a token bucket in memcache holding up to
+burst tokens and refilling at rate tokens a second; a request takes one
+token or is refused with a 403 whose message says when to retry. (Cloud
+Endpoints turns a 429 raised by the API into a 404, so 429 can't be
+used.) When a bucket runs dry the instance also remembers when its next
+token is due, so further requests from that user are refused from
+process memory without a memcache call. The check only reads the
+signed-in user from the request, so a refused request never reaches the
+datastore. Limits are set per endpoint in LIMITS and can be overridden
+per user in USER_LIMITS. Refusals are counted as 'throttled' in the
+instrumentation stats and logged."""
+
+import functools
+import logging
+import math
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+import instrumentation
+
+# endpoint name -> (tokens per second, burst)
+LIMITS = {
+    'create_user': (0.1, 3),
+    'new_game': (0.5, 10),
+    'new_games': (0.05, 2),
+    'join_game': (0.5, 10),
+    'find_match': (0.5, 10),
+    'make_move': (2, 20),
+    'make_moves': (0.5, 5),
+    'cancel_game': (0.5, 10),
+}
+# user -> {endpoint name: (tokens per second, burst)}, e.g. for bots run
+# by tournament organisers.
+USER_LIMITS = {}
+BUCKET_KEY = 'ratelimit:{0}:{1}'
+CAS_ATTEMPTS = 3
+# Entries kept in each instance's table of drained buckets.
+LOCAL_SIZE = 10000
+
+_lock = threading.Lock()
+_blocked_until = {}
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """Raised when a user exceeds an endpoint's rate limit."""
+
+
+def limit_for(name, user):
+    """Returns the (rate, burst) that applies to user on endpoint name, or
+    None if it isn't limited."""
+    return USER_LIMITS.get(user, {}).get(name, LIMITS.get(name))
+
+
+def _take(key, rate, burst):
+    """Takes a token from a bucket in memcache. Returns 0 if one was
+    taken, else the seconds until the next one is due."""
+    client = memcache.Client()
+    ttl = int(math.ceil(burst / float(rate))) + 1
+    for _ in range(CAS_ATTEMPTS):
+        now = time.time()
+        state = client.gets(key)
+        if state is None:
+            if client.add(key, (burst - 1, now), time=ttl):
+                return 0
+            continue
+        tokens, updated = state
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if client.cas(key, (tokens - 1, now), time=ttl):
+            return 0
+    # Memcache is contended or unavailable; fail open.
+    return 0
+
+
+def check(name, user):
+    """Raises TooManyRequestsException if user has no token left for
+    endpoint name."""
+    limit = limit_for(name, user)
+    if limit is None:
+        return
+    key = BUCKET_KEY.format(name, user)
+    now = time.time()
+    with _lock:
+        until = _blocked_until.get(key, 0)
+    if until <= now:
+        wait = _take(key, *limit)
+        if not wait:
+            return
+        until = now + wait
+        with _lock:
+            if len(_blocked_until) >= LOCAL_SIZE:
+                _blocked_until.clear()
+            _blocked_until[key] = until
+    instrumentation.count('throttled')
+    logging.warning('Throttled %s for %s', name, user)
+    raise TooManyRequestsException(
+        'Rate limit exceeded, retry in {0:.1f} seconds'.format(until - now))
+
+
+def rate_limited(func):
+    """Decorator applying the endpoint's rate limit to the signed-in user
+    before the endpoint runs. Anonymous requests are left to the
+    endpoint to refuse."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        user = endpoints.get_current_user()
+        if user:
+            check(func.__name__, str(user))
+        return func(self, request)
+    return wrapper
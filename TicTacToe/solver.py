@@ -0,0 +1,337 @@
+"""solver.py - Move selection for the computer opponent.
+
+Boards of up to 9 squares are solved outright: a negamax pass over every
+reachable position fills a table of best moves, memoized on a canonical
+form of the position under the 8 rotations and reflections of the board.
+Looking a move up is then 8 mask translations and a dict lookup. Larger
+boards fall back to an alpha-beta search with a bounded transposition
+cache, deepened iteratively under a SEARCH_BUDGET_MS time budget so a
+reply costs about that much at most, whatever the board. Positions are
+(mover, other) bitboards in the same encoding as board.py."""
+
+import time
+
+from board import get_rules
+
+TABLE_MAX_SQUARES = 9
+# The search deepens up to SEARCH_DEPTH plies while within its budget, and
+# searches the SEARCH_WIDTH best looking moves at each node.
+SEARCH_DEPTH = 3
+SEARCH_BUDGET_MS = 50
+SEARCH_WIDTH = 8
+TRANSPOSITION_LIMIT = 200000
+WIN_SCORE = 10 ** 9
+EXACT, LOWER, UPPER = 0, 1, 2
+
+_SOLVERS = {}
+
+
+def _popcount(mask):
+    return bin(mask).count('1')
+
+
+def _symmetries(size):
+    """Returns the 8 symmetries of the square board, each as a list
+    mapping a square to the square it moves to."""
+    n = size - 1
+    transforms = [lambda r, c: (r, c), lambda r, c: (c, n - r),
+                  lambda r, c: (n - r, n - c), lambda r, c: (n - c, r),
+                  lambda r, c: (r, n - c), lambda r, c: (n - r, c),
+                  lambda r, c: (c, r), lambda r, c: (n - c, n - r)]
+    perms = []
+    for transform in transforms:
+        perm = []
+        for square in xrange(size * size):
+            row, col = transform(square // size, square % size)
+            perm.append(row * size + col)
+        perms.append(perm)
+    return perms
+
+
+class MoveTable(object):
+    """Perfect play for small boards, precomputed over every position
+    reachable from the empty board."""
+
+    def __init__(self, size, win_length):
+        self.rules = get_rules(size, win_length)
+        squares = self.rules.squares
+        self.perms = _symmetries(size)
+        self.inverse = [[perm.index(square) for square in xrange(squares)]
+                        for perm in self.perms]
+        # mask_maps[i][mask] is mask with every bit moved by symmetry i.
+        self.mask_maps = []
+        for perm in self.perms:
+            mapped = [0] * (1 << squares)
+            for mask in xrange(1, 1 << squares):
+                low = mask & -mask
+                mapped[mask] = mapped[mask ^ low] | \
+                    1 << perm[low.bit_length() - 1]
+            self.mask_maps.append(mapped)
+        # canonical (mover, other) -> (score for mover, best square)
+        self.moves = {}
+        self._solve(0, 0)
+
+    def _canonical(self, mover, other):
+        """Returns the canonical position and the symmetry producing it."""
+        best, best_symmetry = None, 0
+        for symmetry, mapped in enumerate(self.mask_maps):
+            position = (mapped[mover], mapped[other])
+            if best is None or position < best:
+                best, best_symmetry = position, symmetry
+        return best, best_symmetry
+
+    def _solve(self, mover, other):
+        position = self._canonical(mover, other)[0]
+        if position in self.moves:
+            return self.moves[position][0]
+        mover, other = position
+        rules = self.rules
+        occupied = mover | other
+        best_score, best_square = -2, None
+        for square in xrange(rules.squares):
+            if occupied >> square & 1:
+                continue
+            played = mover | 1 << square
+            if rules.is_win(played, square):
+                score = 1
+            elif rules.is_full(played, other):
+                score = 0
+            else:
+                score = -self._solve(other, played)
+            if score > best_score:
+                best_score, best_square = score, square
+                if score == 1:
+                    break
+        self.moves[position] = (best_score, best_square)
+        return best_score
+
+    def best_move(self, mover, other):
+        """Returns the best square for the player to move."""
+        position, symmetry = self._canonical(mover, other)
+        if position not in self.moves:
+            self._solve(mover, other)
+        return self.inverse[symmetry][self.moves[position][1]]
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+class Searcher(object):
+    """Alpha-beta search for boards too large to solve, deepened one ply
+    at a time until its time budget runs out. Positions are scored
+    incrementally, from the lines through the square just played, and
+    only the most promising few moves are searched at each node."""
+
+    def __init__(self, size, win_length, depth=SEARCH_DEPTH,
+                 budget_ms=SEARCH_BUDGET_MS, width=SEARCH_WIDTH,
+                 cache_limit=TRANSPOSITION_LIMIT):
+        self.rules = get_rules(size, win_length)
+        self.depth = depth
+        self.budget = budget_ms / 1e3
+        self.width = width
+        self.cache_limit = cache_limit
+        self.cache = {}
+        self.deadline = None
+        self.neighbours = []
+        for square in xrange(self.rules.squares):
+            row, col = divmod(square, size)
+            mask = 0
+            for d_row in (-1, 0, 1):
+                for d_col in (-1, 0, 1):
+                    r, c = row + d_row, col + d_col
+                    if 0 <= r < size and 0 <= c < size:
+                        mask |= 1 << (r * size + c)
+            self.neighbours.append(mask)
+
+    def _near(self, mover, other):
+        """Empty squares next to a tile; the centre on an empty board."""
+        occupied = mover | other
+        if not occupied:
+            return [self.rules.squares // 2]
+        near, rest = 0, occupied
+        while rest:
+            low = rest & -rest
+            near |= self.neighbours[low.bit_length() - 1]
+            rest ^= low
+        near &= ~occupied
+        squares = []
+        while near:
+            low = near & -near
+            squares.append(low.bit_length() - 1)
+            near ^= low
+        return squares
+
+    @staticmethod
+    def _line_score(line, mover, other):
+        if not line & other:
+            return 4 ** _popcount(line & mover)
+        if not line & mover:
+            return -4 ** _popcount(line & other)
+        return 0
+
+    def _gain(self, mover, other, square):
+        """How much playing square raises the mover's evaluation."""
+        played = mover | 1 << square
+        line_score = self._line_score
+        return sum(line_score(line, played, other) -
+                   line_score(line, mover, other)
+                   for line in self.rules.lines_through[square])
+
+    def _candidates(self, mover, other):
+        """Returns (gain, square) for the best few moves, best first."""
+        moves = sorted(((self._gain(mover, other, square), square)
+                        for square in self._near(mover, other)),
+                       reverse=True)
+        return moves[:self.width]
+
+    def _evaluate(self, mover, other):
+        """Scores open lines, weighting each by how full it is."""
+        line_score = self._line_score
+        return sum(line_score(line, mover, other)
+                   for line in self.rules.lines)
+
+    def _negamax(self, mover, other, score, depth, alpha, beta):
+        """Returns the value of the position for mover, whose evaluation
+        is score."""
+        if self.rules.is_full(mover, other):
+            return 0
+        if depth == 0:
+            return score
+        if time.time() > self.deadline:
+            raise _OutOfTime()
+        position = (mover, other)
+        entry = self.cache.get(position)
+        if entry and entry[0] >= depth:
+            _, value, flag = entry
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                alpha = max(alpha, value)
+            elif flag == UPPER:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+        original_alpha = alpha
+        best = -WIN_SCORE - depth
+        for gain, square in self._candidates(mover, other):
+            played = mover | 1 << square
+            if self.rules.is_win(played, square):
+                best = WIN_SCORE + depth
+                break
+            best = max(best, -self._negamax(other, played, -score - gain,
+                                            depth - 1, -beta, -alpha))
+            alpha = max(alpha, best)
+            if alpha >= beta:
+                break
+        if len(self.cache) >= self.cache_limit:
+            self.cache.clear()
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.cache[position] = (depth, best, flag)
+        return best
+
+    def best_move(self, mover, other):
+        """Returns the best square found for the player to move within
+        the time budget. A winning move is always taken and an immediate
+        threat always blocked."""
+        self.deadline = time.time() + self.budget
+        squares = self._near(mover, other)
+        for square in squares:
+            if self.rules.is_win(mover | 1 << square, square):
+                return square
+        for square in squares:
+            if self.rules.is_win(other | 1 << square, square):
+                return square
+        candidates = self._candidates(mover, other)
+        best_square = candidates[0][1]
+        score = self._evaluate(mover, other)
+        try:
+            for depth in xrange(1, self.depth + 1):
+                alpha, best_at_depth = -WIN_SCORE * 2, best_square
+                # The previous depth's choice first, for earlier cutoffs.
+                for gain, square in sorted(
+                        candidates, key=lambda move: move[1] != best_square):
+                    value = -self._negamax(other, mover | 1 << square,
+                                           -score - gain, depth - 1,
+                                           -WIN_SCORE * 2, -alpha)
+                    if value > alpha:
+                        best_at_depth, alpha = square, value
+                best_square = best_at_depth
+        except _OutOfTime:
+            pass
+        return best_square
+
+
+def get_solver(size=3, win_length=3):
+    """Returns the shared solver for a board, building it on first use."""
+    key = (size, win_length)
+    if key not in _SOLVERS:
+        if size * size <= TABLE_MAX_SQUARES:
+            _SOLVERS[key] = MoveTable(size, win_length)
+        else:
+            _SOLVERS[key] = Searcher(size, win_length)
+    return _SOLVERS[key]
+
+
+def best_move(size, win_length, mover, other):
+    """Returns the square the player owning mover should play."""
+    return get_solver(size, win_length).best_move(mover, other)
+
+
+def benchmark():
+    """Reports move table build time and memory, and lookup and search
+    times."""
+    import sys
+    start = time.time()
+    table = MoveTable(3, 3)
+    built = time.time() - start
+    memory = sys.getsizeof(table.moves) + sum(
+        sys.getsizeof(position) + sys.getsizeof(move)
+        for position, move in table.moves.iteritems()) + sum(
+        sys.getsizeof(mapped) for mapped in table.mask_maps)
+    print 'move table 3x3: {0} positions, built in {1:.1f} ms, ' \
+        '~{2} KB'.format(len(table.moves), built * 1e3, memory // 1024)
+    number = 10000
+    start = time.time()
+    for _ in xrange(number):
+        table.best_move(0b000010001, 0b100000100)
+    print 'table lookup: {0:.2f} us/move'.format(
+        (time.time() - start) / number * 1e6)
+    for size, win_length in ((7, 4), (15, 5), (19, 5)):
+        for stones in (2, 20, 60):
+            if stones >= size * size:
+                continue
+            searcher = Searcher(size, win_length)
+            mover, other = _random_position(searcher.rules, stones)
+            start = time.time()
+            searcher.best_move(mover, other)
+            print 'alpha-beta {0}x{0} k={1}, {2} stones: {3:.1f} ms, ' \
+                '{4} cached positions'.format(
+                    size, win_length, stones, (time.time() - start) * 1e3,
+                    len(searcher.cache))
+
+
+def _random_position(rules, stones, seed=0):
+    """Returns (mover, other) with stones tiles placed at random around
+    the centre of the board, for the benchmark."""
+    import random
+    rng = random.Random(seed)
+    size = rules.size
+    spread = min(size // 2, stones // 4 + 1)
+    centre = size // 2
+    squares = [row * size + col
+               for row in xrange(centre - spread, centre + spread + 1)
+               for col in xrange(centre - spread, centre + spread + 1)]
+    placed = rng.sample(squares, min(stones, len(squares)))
+    mover = sum(1 << square for square in placed[1::2])
+    other = sum(1 << square for square in placed[0::2])
+    return mover, other
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""startup_benchmark.py - Cold start timing under the local dev server.
+
+Each run starts dev_appserver.py on the app with an empty datastore and
+waits until it answers its own sign-in page, which loads none of the
+application code. It then times the first API request, which pays for
+importing the API on a cold instance, and a second one for comparison.
+With --warmup, /_ah/warmup is requested first, the way App Engine does
+before sending traffic to a new instance, and timed separately. Reports
+every run and the medians as JSON so runs can be compared between
+versions.
+
+Usage:
+    python startup_benchmark.py --sdk PATH_TO_GOOGLE_APPENGINE [--runs N]
+        [--warmup] [--port N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Served by dev_appserver itself rather than by an instance of the app.
+READY_PATH = '/_ah/login'
+FIRST_PATH = '/_ah/api/tic_tac_toe/v1/user/games/rankings'
+WARMUP_PATH = '/_ah/warmup'
+# The dev server's sign-in cookie for an admin, which /_ah/warmup needs.
+ADMIN_COOKIE = 'dev_appserver_login=test@example.com:True:1'
+READY_TIMEOUT = 120
+
+
+def _fetch(url, headers=None):
+    """Returns how long fetching url took, in milliseconds."""
+    start = time.time()
+    urllib2.urlopen(urllib2.Request(url, headers=headers or {})).read()
+    return (time.time() - start) * 1e3
+
+
+def _wait_ready(url, timeout=READY_TIMEOUT):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib2.urlopen(url).read()
+            return
+        except urllib2.HTTPError:
+            # Any HTTP response means the server is accepting requests.
+            return
+        except (urllib2.URLError, socket.error):
+            if time.time() > deadline:
+                raise RuntimeError('dev_appserver did not start')
+            time.sleep(0.05)
+
+
+def run_once(sdk, port, warmup=False):
+    """Starts a fresh dev server and returns the timings of one cold
+    start, in milliseconds."""
+    storage = tempfile.mkdtemp()
+    base = 'http://localhost:{0}'.format(port)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(sdk, 'dev_appserver.py'),
+             '--port', str(port), '--admin_port', '0', '--api_port', '0',
+             '--storage_path', storage, '--skip_sdk_update_check', 'yes',
+             '--automatic_restart', 'no', APP_DIR],
+            stdout=devnull, stderr=devnull)
+        try:
+            _wait_ready(base + READY_PATH)
+            result = {'server_ready_ms': (time.time() - start) * 1e3}
+            if warmup:
+                result['warmup_ms'] = _fetch(base + WARMUP_PATH,
+                                             {'Cookie': ADMIN_COOKIE})
+            result['first_request_ms'] = _fetch(base + FIRST_PATH)
+            result['time_to_first_response_ms'] = \
+                (time.time() - start) * 1e3
+            result['second_request_ms'] = _fetch(base + FIRST_PATH)
+            return result
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(storage, ignore_errors=True)
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def run(sdk, runs=5, port=8090, warmup=False):
+    """Runs the cold start runs times and returns the report."""
+    results = [run_once(sdk, port, warmup) for _ in range(runs)]
+    return {
+        'warmup': warmup,
+        'runs': [dict((key, round(value, 1))
+                      for key, value in result.items())
+                 for result in results],
+        'median': dict((key, round(_median([r[key] for r in results]), 1))
+                       for key in results[0])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the google_appengine SDK')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--warmup', action='store_true',
+                        help='request /_ah/warmup before the first request')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+    report = json.dumps(run(args.sdk, args.runs, args.port, args.warmup),
+                        indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
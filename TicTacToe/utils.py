@@ -1,13 +1,49 @@
 """utils.py - File for collecting general utility functions."""
 
+import hashlib
 import logging
 from google.appengine.ext import ndb
 from google.appengine.api import urlfetch
-import endpoints
 import os
+import random
+import threading
 import time
 import json
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?{0}={1}'
+TOKENINFO_DEADLINE = 5
+TOKENINFO_ATTEMPTS = 3
+# Base of the jittered exponential backoff between tokeninfo attempts.
+BACKOFF_SECONDS = 0.2
+TOKEN_CACHE_KEY = 'tokeninfo:{0}'
+# Verified tokens are cached until they expire, but at most this long.
+MAX_TOKEN_TTL = 3600
+# Rejected tokens are remembered this long.
+INVALID_TOKEN_TTL = 60
+# Entries kept in each instance's in-process token cache.
+TOKEN_CACHE_SIZE = 1000
+# tokeninfo is skipped for BREAKER_COOLDOWN seconds after this many
+# consecutive failed calls.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+
+def key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key a urlsafe key string encodes. Raises a
+    BadRequestException if the string is malformed."""
+    # endpoints is only needed on this path; importing it here keeps it
+    # out of the cron and task handlers, which don't serve the API.
+    import endpoints
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception as e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -22,30 +58,45 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception as e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
+    return get_by_urlsafe_async(urlsafe, model).get_result()
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Asynchronous get_by_urlsafe(). Returns a Future so the get can run
+    alongside the request's other RPCs."""
+    entity = yield _get_live_or_archived_async(key_from_urlsafe(urlsafe),
+                                               model)
+    raise ndb.Return(entity)
 
 
 def get_by_passcode(passcode, model):
     """Returns an ndb.Model entity that the game passkey points to.
     Raises an error if the entity is of the incorrect kind."""
+    return get_by_passcode_async(passcode, model).get_result()
+
+
+@ndb.tasklet
+def get_by_passcode_async(passcode, model):
+    """Asynchronous get_by_passcode(). Returns a Future."""
     key = int(passcode.replace("-", ""), 36)
     logging.info(key)
-    entity = model.get_by_id(key)
+    entity = yield _get_live_or_archived_async(ndb.Key(model, key), model)
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def _get_live_or_archived_async(key, model):
+    """Gets key, falling back to the archive of models that keep one
+    (see Game.get_archived_async) when the live entity is gone."""
+    entity = yield key.get_async()
+    if entity is None and key.kind() == model._get_kind() and \
+            hasattr(model, 'get_archived_async'):
+        entity = yield model.get_archived_async(key.id())
+    raise ndb.Return(_check_kind(entity, model))
+
+
+def _check_kind(entity, model):
     if not entity:
         return None
     if not isinstance(entity, model):
@@ -53,6 +104,121 @@ def get_by_passcode(passcode, model):
     return entity
 
 
+class CircuitBreaker(object):
+    """Per-instance circuit breaker for a remote service. After threshold
+    consecutive failures calls are refused for cooldown seconds, then a
+    single call is let through to probe whether the service is back."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns whether a call may be made now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # Half open: this call probes, the others keep failing fast.
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+_tokeninfo_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
+
+def _remember_token(digest, user_id, expires):
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_SIZE:
+            _token_cache.clear()
+        _token_cache[digest] = (user_id, expires)
+
+
+@ndb.tasklet
+def _fetch_tokeninfo_async(token, token_type):
+    """Asks the tokeninfo endpoint about a token. Returns its response as
+    a dict, {} if the token was rejected, or None if the endpoint could
+    not be reached."""
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        if not _tokeninfo_breaker.allow():
+            logging.warning('tokeninfo circuit open, token not verified')
+            raise ndb.Return(None)
+        try:
+            resp = yield ndb.get_context().urlfetch(
+                TOKENINFO_URL.format(token_type, token),
+                deadline=TOKENINFO_DEADLINE)
+        except urlfetch.Error as e:
+            logging.warning('tokeninfo fetch failed: %s', e)
+            resp = None
+        if resp is not None and resp.status_code == 200:
+            _tokeninfo_breaker.succeeded()
+            raise ndb.Return(json.loads(resp.content))
+        if resp is not None and 400 <= resp.status_code < 500:
+            _tokeninfo_breaker.succeeded()
+            if token_type == 'access_token' or \
+                    'invalid_token' not in resp.content:
+                raise ndb.Return({})
+            # Not an id token; it may still be a valid access token.
+            token_type = 'access_token'
+            continue
+        _tokeninfo_breaker.failed()
+        if attempt + 1 < TOKENINFO_ATTEMPTS:
+            # Full jitter, so instances retrying together spread out. The
+            # wait yields to the event loop instead of blocking on sleep.
+            yield ndb.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+    raise ndb.Return(None)
+
+
+@ndb.tasklet
+def verify_token_async(token, token_type='id_token'):
+    """Returns a Future for the user id an OAuth token belongs to, or ''
+    if the token is invalid or could not be verified. Results are cached
+    in process and in memcache until the token expires; rejected tokens
+    are cached for INVALID_TOKEN_TTL seconds."""
+    digest = hashlib.sha256(token).hexdigest()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(digest)
+    if cached and cached[1] > now:
+        raise ndb.Return(cached[0])
+    ctx = ndb.get_context()
+    cache_key = TOKEN_CACHE_KEY.format(digest)
+    cached = yield ctx.memcache_get(cache_key)
+    if cached is not None:
+        _remember_token(digest, *cached)
+        raise ndb.Return(cached[0])
+    info = yield _fetch_tokeninfo_async(token, token_type)
+    if info is None:
+        # Not cached, so the next request tries tokeninfo again.
+        raise ndb.Return('')
+    user_id = info.get('user_id', '')
+    if user_id:
+        ttl = min(int(info.get('expires_in', 0)), MAX_TOKEN_TTL)
+    else:
+        ttl = INVALID_TOKEN_TTL
+    if ttl > 0:
+        _remember_token(digest, user_id, now + ttl)
+        yield ctx.memcache_set(cache_key, (user_id, now + ttl), time=ttl)
+    raise ndb.Return(user_id)
+
+
 def getUserId(user, id_type="oauth"):
     if id_type == "email":
         return user.email()
@@ -64,19 +230,4 @@ def getUserId(user, id_type="oauth"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return verify_token_async(token, token_type).get_result()